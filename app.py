@@ -1,28 +1,188 @@
+import csv
+import hashlib
+import io
 import json
+import math
+import multiprocessing
 import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
 import time
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import numpy as np
 import psycopg2
 import requests
 import yaml
-from psycopg2.extensions import AsIs
+from psycopg2.extras import execute_values
+
+# the account this process is working for, worker processes switch between
+# accounts while a single-user setup keeps the defaults
+active_account = {
+    "name": None,
+    "secrets_dir": "./secrets",
+    "database_schema": None,
+}
+
+
+def get_secrets_path(file_name):
+    return os.path.join(active_account["secrets_dir"], file_name)
+
+
+def get_account_path(env_name, file_name):
+    # an override applies to every account, so each account gets its own path
+    # next to it instead of sharing the file
+    path = os.environ.get(env_name)
+    if path is None:
+        return get_secrets_path(file_name)
+    if path and active_account["name"] is not None:
+        root, extension = os.path.splitext(path)
+        path = root + "-" + active_account["name"] + extension
+    return path
 
 
 def get_database_connection():
+    # each account's tables live in its own schema
+    options = None
+    if active_account["database_schema"]:
+        options = "-c search_path=" + active_account["database_schema"]
     return psycopg2.connect(
         host=os.environ.get("POSTGRES_HOSTNAME"),
         port=os.environ.get("POSTGRES_PORT", "5432"),
         database=os.environ.get("POSTGRES_DB", "sandiego"),
         user=os.environ.get("POSTGRES_USERNAME", "sandiego"),
         password=os.environ.get("POSTGRES_PASSWORD"),
+        options=options,
     )
 
 
-def query_hass(query_start, sensors):
+# one pooled keep-alive session per provider, reused across runs
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_session(provider):
+    with http_sessions_lock:
+        if provider not in http_sessions:
+            pool_size = int(os.environ.get("SANDIEGO_FITBIT_WORKERS", "4"))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[provider] = session
+        return http_sessions[provider]
+
+
+# instrumentation of the current run, published as prometheus gauges once the
+# run finishes so a scrape never sees a half-finished run, workers keep the
+# last finished run of every account they ran
+run_metrics = {
+    "lock": threading.Lock(),
+    "current": {},
+    "finished": {},
+    "exported": "",
+}
+
+
+def record_run_metric(name, labels, value, add=False):
+    if active_account["name"] is not None:
+        labels = {**labels, "account": active_account["name"]}
+    metric_key = (name, tuple(sorted(labels.items())))
+    with run_metrics["lock"]:
+        if add:
+            value += run_metrics["current"].get(metric_key, 0)
+        run_metrics["current"][metric_key] = value
+
+
+@contextmanager
+def time_stage(stage, **labels):
+    stage_start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_run_metric(
+            "sandiego_stage_seconds",
+            {"stage": stage, **labels},
+            time.monotonic() - stage_start,
+            add=True,
+        )
+
+
+def format_run_metrics(metrics):
+    lines = []
+    for name in sorted({name for name, _ in metrics}):
+        lines.append("# TYPE " + name + " gauge")
+        for (metric_name, labels), value in sorted(metrics.items()):
+            if metric_name != name:
+                continue
+            if labels:
+                label_string = ",".join([f'{key}="{value}"' for key, value in labels])
+                lines.append(f"{name}{{{label_string}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_run_metrics():
+    record_run_metric("sandiego_last_run_timestamp_seconds", {}, time.time())
+    record_run_metric(
+        "sandiego_fitbit_rate_limit_remaining", {}, fitbit_rate_limit["remaining"]
+    )
+    with run_metrics["lock"]:
+        account_metrics = run_metrics["current"]
+        run_metrics["finished"][active_account["name"]] = account_metrics
+        run_metrics["current"] = {}
+        run_metrics["exported"] = format_run_metrics(
+            {
+                metric_key: value
+                for finished_metrics in run_metrics["finished"].values()
+                for metric_key, value in finished_metrics.items()
+            }
+        )
+
+    # for the node exporter textfile collector, replaced atomically, one file
+    # per account so worker processes never overwrite each other
+    if os.environ.get("SANDIEGO_METRICS_FILE"):
+        metrics_file = get_account_path("SANDIEGO_METRICS_FILE", "metrics.prom")
+        with open(metrics_file + ".tmp", "w") as file:
+            file.write(format_run_metrics(account_metrics))
+        os.replace(metrics_file + ".tmp", metrics_file)
+
+
+class RunMetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = run_metrics["exported"].encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_metrics_server():
+    metrics_port = os.environ.get("SANDIEGO_METRICS_PORT")
+    if metrics_port:
+        server = ThreadingHTTPServer(("", int(metrics_port)), RunMetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Serving metrics on port", metrics_port)
+
+
+def query_hass(query_start, query_end, sensors):
     sensors_string = ",".join([s for s in sensors])
-    response = requests.get(
+    response = get_http_session("homeassistant").get(
         os.environ.get("HASS_URL") + "/api/history/period/" + query_start.isoformat(),
         headers={
             "authorization": "Bearer " + os.environ.get("HASS_API_KEY"),
@@ -30,109 +190,226 @@ def query_hass(query_start, sensors):
         },
         params={
             "filter_entity_id": sensors_string,
-            "end_time": datetime.now(timezone.utc).isoformat(),
-            # "no_attributes": True,
+            "end_time": query_end.isoformat(),
+            "minimal_response": "",
+            "no_attributes": "",
         },
     )
+    record_run_metric("sandiego_api_calls", {"provider": "homeassistant"}, 1, True)
+    record_run_metric(
+        "sandiego_api_bytes",
+        {"provider": "homeassistant"},
+        len(response.content),
+        True,
+    )
     return response.json()
 
 
-def format_hass_timestamps(response):
-    data_return = []
-    for list_item in response:
-        converted_list = []
-        for item in list_item:
-            converted_item = {}
-            for key, value in item.items():
-                if key in ["last_changed", "last_updated"]:
-                    converted_item[key] = datetime.fromisoformat(value)
-                else:
-                    converted_item[key] = value
-            converted_list.append(converted_item)
-        data_return.append(converted_list)
-    return data_return
+def append_hass_change(epochs, states, epoch, state):
+    # keep only real state changes, in order
+    if len(epochs) and (epoch <= epochs[-1] or state == states[-1]):
+        return False
+    epochs.append(epoch)
+    states.append(state)
+    return True
+
+
+def parse_hass_history(response, histories):
+    # with minimal_response only the first entry of each list has the entity_id
+    for entity_history in response:
+        if not len(entity_history):
+            continue
+        epochs, states = histories[entity_history[0]["entity_id"]]
+        for item in entity_history:
+            append_hass_change(
+                epochs,
+                states,
+                datetime.fromisoformat(item["last_changed"]).timestamp(),
+                sys.intern(item["state"]),
+            )
 
 
-def get_data_hass(query_start, metric_data):
+def get_data_hass(query_start, query_end, metric_data):
     print("Downloading metrics from Home Assistant...")
-    hass_metrics = list(
+    hass_metrics = sorted(
         {
             metric["hass_metric_id"]
             for metric in metric_data.values()
             if metric["provider"] == "homeassistant"
         }
     )
-    if len(hass_metrics):
-        data_homeassistant_raw = query_hass(query_start, hass_metrics)
-        data_homeassistant_formatted = format_hass_timestamps(data_homeassistant_raw)
-        if len(hass_metrics) != len(data_homeassistant_formatted):
-            print("Not enough records returned from Home Assistant!")
-            print(
-                "Requested "
-                + str(len(hass_metrics))
-                + " records, received "
-                + str(len(data_homeassistant_formatted))
-            )
-            for metric in hass_metrics:
-                if not metric in str(data_homeassistant_formatted):
-                    print("Missing: " + metric)
-        data_homeassistant = {
-            metric: data_homeassistant_formatted[hass_metrics.index(metric)]
-            for metric in hass_metrics
-        }
-        return data_homeassistant
-    else:
+    if not len(hass_metrics):
         return {}
 
+    # fetch in time and entity chunks so only one chunk of json is held at once
+    chunk_duration = timedelta(
+        hours=int(os.environ.get("SANDIEGO_HASS_CHUNK_HOURS", "24"))
+    )
+    chunk_entities = int(os.environ.get("SANDIEGO_HASS_CHUNK_ENTITIES", "10"))
+    histories = {metric: (array("d"), []) for metric in hass_metrics}
+    for i in range(0, len(hass_metrics), chunk_entities):
+        chunk_start = query_start
+        while chunk_start < query_end:
+            chunk_end = min(chunk_start + chunk_duration, query_end)
+            parse_hass_history(
+                query_hass(
+                    chunk_start, chunk_end, hass_metrics[i : i + chunk_entities]
+                ),
+                histories,
+            )
+            chunk_start = chunk_end
 
-def query_fitbit(url):
-    # load secrets file
-    with open("./secrets/fitbit.json", "r") as file:
-        fitbit_secrets = json.load(file)
+    missing_metrics = [
+        metric for metric in hass_metrics if not len(histories[metric][0])
+    ]
+    if len(missing_metrics):
+        print("Not enough records returned from Home Assistant!")
+        print(
+            "Requested "
+            + str(len(hass_metrics))
+            + " records, received "
+            + str(len(hass_metrics) - len(missing_metrics))
+        )
+        for metric in missing_metrics:
+            print("Missing: " + metric)
 
-    # pull data from api
-    response = requests.get(
-        url,
-        headers={"authorization": "Bearer " + fitbit_secrets["access_token"]},
-        params={"timezone": "UTC"},
-    )
+    # compact per-entity arrays of change times and states
+    return {
+        metric: (np.frombuffer(epochs, dtype=np.float64), states)
+        for metric, (epochs, states) in histories.items()
+    }
 
-    if response.status_code == 401:
-        # request new key
-        response = requests.post(
-            "https://api.fitbit.com/oauth2/token",
-            headers={
-                "authorization": "Basic " + fitbit_secrets["basic_token"],
-                "content-type": "application/x-www-form-urlencoded",
-            },
-            data={
-                "grant_type": "refresh_token",
-                "client_id": fitbit_secrets["client_id"],
-                "refresh_token": fitbit_secrets["refresh_token"],
-            },
-        ).json()
 
-        # update secrets file
-        fitbit_secrets.update(
-            {
-                "access_token": response["access_token"],
-                "refresh_token": response["refresh_token"],
-            }
+# shared across threads and runs, refilled when fitbit's hourly window resets
+fitbit_rate_limit = {
+    "lock": threading.Lock(),
+    "limit": 150,
+    "remaining": 150,
+    "reset_at": 0.0,
+}
+
+# tokens are loaded once and only written back to disk when they change
+fitbit_auth = {
+    "lock": threading.Lock(),
+    "secrets": None,
+}
+
+
+def acquire_fitbit_request():
+    while True:
+        with fitbit_rate_limit["lock"]:
+            now = time.time()
+            if now >= fitbit_rate_limit["reset_at"]:
+                fitbit_rate_limit["remaining"] = fitbit_rate_limit["limit"]
+                fitbit_rate_limit["reset_at"] = now + 3600
+            if fitbit_rate_limit["remaining"] > 0:
+                fitbit_rate_limit["remaining"] -= 1
+                return
+            wait_seconds = fitbit_rate_limit["reset_at"] - now
+        print("Fitbit rate limit reached, waiting", int(wait_seconds), "seconds...")
+        time.sleep(wait_seconds)
+
+
+def update_fitbit_rate_limit(headers, rate_limited=False):
+    with fitbit_rate_limit["lock"]:
+        now = time.time()
+        if "fitbit-rate-limit-limit" in headers:
+            fitbit_rate_limit["limit"] = int(headers["fitbit-rate-limit-limit"])
+        if "fitbit-rate-limit-reset" in headers:
+            fitbit_rate_limit["reset_at"] = now + int(
+                headers["fitbit-rate-limit-reset"]
+            )
+        if "fitbit-rate-limit-remaining" in headers:
+            # other requests may still be in flight, never hand back their tokens
+            fitbit_rate_limit["remaining"] = min(
+                fitbit_rate_limit["remaining"],
+                int(headers["fitbit-rate-limit-remaining"]),
+            )
+        if rate_limited:
+            fitbit_rate_limit["remaining"] = 0
+            if "retry-after" in headers:
+                fitbit_rate_limit["reset_at"] = now + int(headers["retry-after"])
+            elif "fitbit-rate-limit-reset" not in headers:
+                fitbit_rate_limit["reset_at"] = now + 60
+
+
+def get_fitbit_secrets():
+    with fitbit_auth["lock"]:
+        if fitbit_auth["secrets"] is None:
+            with open(get_secrets_path("fitbit.json"), "r") as file:
+                fitbit_auth["secrets"] = json.load(file)
+        return fitbit_auth["secrets"]
+
+
+def refresh_fitbit_token(expired_access_token):
+    with fitbit_auth["lock"]:
+        fitbit_secrets = fitbit_auth["secrets"]
+        if fitbit_secrets["access_token"] != expired_access_token:
+            # another request already refreshed it
+            return
+
+        # request new key
+        response = (
+            get_http_session("fitbit")
+            .post(
+                os.environ.get(
+                    "FITBIT_TOKEN_URL",
+                    os.environ.get("FITBIT_API_URL", "https://api.fitbit.com")
+                    + "/oauth2/token",
+                ),
+                headers={
+                    "authorization": "Basic " + fitbit_secrets["basic_token"],
+                    "content-type": "application/x-www-form-urlencoded",
+                },
+                data={
+                    "grant_type": "refresh_token",
+                    "client_id": fitbit_secrets["client_id"],
+                    "refresh_token": fitbit_secrets["refresh_token"],
+                },
+            )
+            .json()
         )
-        with open("./secrets/fitbit.json", "w") as file:
-            json.dump(fitbit_secrets, file)
 
-        # try again
-        response = requests.get(
+        # update secrets in memory and on disk
+        fitbit_auth["secrets"] = {
+            **fitbit_secrets,
+            "access_token": response["access_token"],
+            "refresh_token": response["refresh_token"],
+        }
+        secrets_file = get_secrets_path("fitbit.json")
+        with open(secrets_file + ".tmp", "w") as file:
+            json.dump(fitbit_auth["secrets"], file)
+        os.replace(secrets_file + ".tmp", secrets_file)
+
+
+def query_fitbit(url):
+    max_retries = int(os.environ.get("SANDIEGO_FITBIT_MAX_RETRIES", "5"))
+    for attempt in range(max_retries + 1):
+        fitbit_secrets = get_fitbit_secrets()
+
+        # pull data from api
+        acquire_fitbit_request()
+        response = get_http_session("fitbit").get(
             url,
             headers={"authorization": "Bearer " + fitbit_secrets["access_token"]},
             params={"timezone": "UTC"},
         )
+        record_run_metric("sandiego_api_calls", {"provider": "fitbit"}, 1, True)
+        record_run_metric(
+            "sandiego_api_bytes", {"provider": "fitbit"}, len(response.content), True
+        )
 
-    elif response.status_code == 429:
-        raise Exception("Fitbit API rate-limited.", response.headers)
+        if response.status_code == 401:
+            update_fitbit_rate_limit(response.headers)
+            refresh_fitbit_token(fitbit_secrets["access_token"])
+        elif response.status_code == 429:
+            # back off until the window resets, then resume
+            update_fitbit_rate_limit(response.headers, rate_limited=True)
+        else:
+            update_fitbit_rate_limit(response.headers)
+            return response.json()
 
-    return response.json()
+    raise Exception("Fitbit API request failed after retries.", response.headers)
 
 
 def dates_to_query_fitbit(query_start, query_end):
@@ -145,6 +422,162 @@ def dates_to_query_fitbit(query_start, query_end):
     return query_dates
 
 
+def fitbit_date_is_settled(query_date_str):
+    # devices sync late, so only days before yesterday are final
+    settled_before = datetime.now(timezone.utc).date() - timedelta(days=1)
+    return query_date_str < settled_before.isoformat()
+
+
+def get_fitbit_url_start(url_schema):
+    # schemas given as paths are resolved against the api url, so the cache
+    # key is the same as for the full url
+    if url_schema["url_start"].startswith("/"):
+        return (
+            os.environ.get("FITBIT_API_URL", "https://api.fitbit.com")
+            + url_schema["url_start"]
+        )
+    return url_schema["url_start"]
+
+
+def get_fitbit_cache_path(url_schema, fitbit_type, query_date_str):
+    cache_dir = get_account_path("SANDIEGO_FITBIT_CACHE_DIR", "fitbit_cache")
+    if not cache_dir:
+        return None
+    schema_hash = hashlib.sha1(
+        (get_fitbit_url_start(url_schema) + url_schema["url_end"]).encode()
+    ).hexdigest()[:8]
+    return os.path.join(
+        cache_dir, fitbit_type + "-" + schema_hash, query_date_str + ".json"
+    )
+
+
+def read_fitbit_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    with open(cache_path, "r") as file:
+        response = json.load(file)
+    # mark as recently used for eviction
+    os.utime(cache_path)
+    return response
+
+
+def write_fitbit_cache(cache_path, response):
+    if cache_path is None or "errors" in response:
+        return
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + ".tmp", "w") as file:
+        json.dump(response, file)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def evict_fitbit_cache():
+    cache_dir = get_account_path("SANDIEGO_FITBIT_CACHE_DIR", "fitbit_cache")
+    if not cache_dir or not os.path.exists(cache_dir):
+        return
+    max_age = timedelta(days=int(os.environ.get("SANDIEGO_FITBIT_CACHE_DAYS", "400")))
+    max_bytes = int(os.environ.get("SANDIEGO_FITBIT_CACHE_MB", "500")) * 1024 * 1024
+
+    cache_files = []
+    for directory, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            cache_path = os.path.join(directory, file_name)
+            cache_stat = os.stat(cache_path)
+            cache_files.append((cache_stat.st_mtime, cache_stat.st_size, cache_path))
+
+    # drop entries unused for too long, then least recently used until small enough
+    cache_files.sort()
+    expire_before = (datetime.now(timezone.utc) - max_age).timestamp()
+    total_bytes = sum([cache_size for _, cache_size, _ in cache_files])
+    for cache_mtime, cache_size, cache_path in cache_files:
+        if cache_mtime >= expire_before and total_bytes <= max_bytes:
+            break
+        os.remove(cache_path)
+        total_bytes -= cache_size
+
+
+# date-range responses hold a list under the fitbit type, each item naming
+# the date it belongs to
+FITBIT_RANGE_DATE_KEYS = {
+    "sleep": "dateOfSleep",
+    "hrv": "dateTime",
+}
+
+
+def split_fitbit_range(fitbit_type, query_dates, response):
+    # back into the single-date shape the aggregators expect
+    if "errors" in response:
+        return {query_date_str: response for query_date_str in query_dates}
+    date_key = FITBIT_RANGE_DATE_KEYS[fitbit_type]
+    split = {query_date_str: {fitbit_type: []} for query_date_str in query_dates}
+    for item in response.get(fitbit_type, []):
+        if item[date_key] in split:
+            split[item[date_key]][fitbit_type].append(item)
+    return split
+
+
+def get_fitbit_requests(fitbit_type, url_schema, query_dates, query_start, query_end):
+    # dates still to fetch are grouped into as few requests as the url schema
+    # allows, returned as (dates, url, cacheable)
+    request_specs = []
+    range_max_days = url_schema.get("range_max_days", 1)
+    if fitbit_type not in FITBIT_RANGE_DATE_KEYS:
+        range_max_days = 1
+    run_dates = []
+    for i, query_date_str in enumerate(query_dates):
+        run_dates.append(query_date_str)
+        run_ends = (
+            i + 1 == len(query_dates)
+            or query_dates[i + 1]
+            != (
+                datetime.fromisoformat(query_date_str).date() + timedelta(days=1)
+            ).isoformat()
+        )
+        if len(run_dates) < range_max_days and not run_ends:
+            continue
+        if len(run_dates) > 1:
+            url = (
+                get_fitbit_url_start(url_schema)
+                + run_dates[0]
+                + "/"
+                + run_dates[-1]
+                + url_schema["url_end"]
+            )
+            request_specs.append((run_dates, url, True))
+            run_dates = []
+            continue
+
+        # unsettled intraday days cut by the window only fetch the time span
+        # needed, settled days are fetched whole so they can be cached
+        start_time = "00:00"
+        end_time = "23:59"
+        if query_date_str == query_start.date().isoformat():
+            start_time = query_start.strftime("%H:%M")
+        if query_date_str == query_end.date().isoformat():
+            end_time = query_end.strftime("%H:%M")
+        if (
+            "url_end_time" in url_schema
+            and not fitbit_date_is_settled(query_date_str)
+            and (start_time, end_time) != ("00:00", "23:59")
+        ):
+            url = (
+                get_fitbit_url_start(url_schema)
+                + query_date_str
+                + url_schema["url_end_time"].format(
+                    start_time=start_time, end_time=end_time
+                )
+            )
+            request_specs.append((run_dates, url, False))
+        else:
+            url = (
+                get_fitbit_url_start(url_schema)
+                + query_date_str
+                + url_schema["url_end"]
+            )
+            request_specs.append((run_dates, url, True))
+        run_dates = []
+    return request_specs
+
+
 def get_data_fitbit(query_start, query_end, url_schemas, metric_config):
     fitbit_types = list(
         {
@@ -154,145 +587,431 @@ def get_data_fitbit(query_start, query_end, url_schemas, metric_config):
         }
     )
 
+    query_start = query_start.astimezone(timezone.utc)
+    query_end = query_end.astimezone(timezone.utc)
     query_dates = dates_to_query_fitbit(query_start, query_end)
-    print(
-        "Downloading metrics from Fitbit:",
-        len(fitbit_types) * len(query_dates),
-        "calls...",
-    )
-    # print("Requesting metrics:", fitbit_types)
-    # print("Requesting dates:", query_dates)
 
+    # settled days are served from the on-disk cache when present
     data_fitbit = {}
+    query_requests = []
+    cache_hits = 0
     for fitbit_type in fitbit_types:
         data_fitbit[fitbit_type] = {}
+        missing_dates = []
         for query_date_str in query_dates:
-            url = (
-                url_schemas[fitbit_type]["url_start"]
-                + query_date_str
-                + url_schemas[fitbit_type]["url_end"]
-            )
-            response = query_fitbit(url)
-            data_fitbit[fitbit_type].update({query_date_str: response})
+            if fitbit_date_is_settled(query_date_str):
+                response = read_fitbit_cache(
+                    get_fitbit_cache_path(
+                        url_schemas[fitbit_type], fitbit_type, query_date_str
+                    )
+                )
+                if response is not None:
+                    data_fitbit[fitbit_type][query_date_str] = response
+                    cache_hits += 1
+                    continue
+            missing_dates.append(query_date_str)
+        for request_dates, url, cacheable in get_fitbit_requests(
+            fitbit_type,
+            url_schemas[fitbit_type],
+            missing_dates,
+            query_start,
+            query_end,
+        ):
+            query_requests.append((fitbit_type, request_dates, url, cacheable))
+
+    record_run_metric("sandiego_fitbit_cache_hits", {}, cache_hits)
+    print(
+        "Downloading metrics from Fitbit:",
+        len(query_requests),
+        "calls,",
+        cache_hits,
+        "from cache...",
+    )
+    with ThreadPoolExecutor(
+        max_workers=int(os.environ.get("SANDIEGO_FITBIT_WORKERS", "4"))
+    ) as executor:
+        responses = executor.map(query_fitbit, [url for _, _, url, _ in query_requests])
+        for (fitbit_type, request_dates, _, cacheable), response in zip(
+            query_requests, responses
+        ):
+            if len(request_dates) > 1:
+                date_responses = split_fitbit_range(
+                    fitbit_type, request_dates, response
+                )
+            else:
+                date_responses = {request_dates[0]: response}
+            for query_date_str, date_response in date_responses.items():
+                if cacheable and fitbit_date_is_settled(query_date_str):
+                    write_fitbit_cache(
+                        get_fitbit_cache_path(
+                            url_schemas[fitbit_type], fitbit_type, query_date_str
+                        ),
+                        date_response,
+                    )
+                data_fitbit[fitbit_type][query_date_str] = date_response
+
+    # keep the original date order for the aggregators
+    for fitbit_type in fitbit_types:
+        data_fitbit[fitbit_type] = {
+            query_date_str: data_fitbit[fitbit_type][query_date_str]
+            for query_date_str in query_dates
+        }
+    evict_fitbit_cache()
     return data_fitbit
 
 
-def state_data_to_bucket_durations(bucket_start, bucket_end, state_data, last_state):
-    changes_before_start = [
-        row for row in state_data if row["last_changed"] < bucket_end
-    ]
-    changes_in_bucket = [
-        row for row in state_data if bucket_start < row["last_changed"] < bucket_end
-    ]
-    if len(changes_before_start) + len(changes_in_bucket) == 0:
-        # no state changes before bucket_end, use last_state
-        return {last_state: bucket_end - bucket_start}
-    elif len(changes_in_bucket) == 0:
-        # no state changes between bucket_start and bucket_end, use previous state
-        return {changes_before_start[-1]["state"]: bucket_end - bucket_start}
+def load_watermarks():
+    watermark_file = get_account_path("SANDIEGO_WATERMARK_FILE", "watermarks.json")
+    if not os.path.exists(watermark_file):
+        return {"providers": {}, "metrics": {}}
+    with open(watermark_file, "r") as file:
+        watermarks = json.load(file)
+    return {
+        section: {key: datetime.fromisoformat(value) for key, value in items.items()}
+        for section, items in watermarks.items()
+    }
+
+
+def save_watermarks(watermarks):
+    watermark_file = get_account_path("SANDIEGO_WATERMARK_FILE", "watermarks.json")
+    with open(watermark_file + ".tmp", "w") as file:
+        json.dump(
+            {
+                section: {key: value.isoformat() for key, value in items.items()}
+                for section, items in watermarks.items()
+            },
+            file,
+        )
+    os.replace(watermark_file + ".tmp", watermark_file)
+
+
+def merge_hass_history(retained, fetched, query_start):
+    # append only real state changes newer than what we already hold
+    epochs = array("d")
+    epochs.frombytes(np.asarray(retained[0], dtype=np.float64).tobytes())
+    states = list(retained[1])
+    changed_from = None
+    for epoch, state in zip(fetched[0].tolist(), fetched[1]):
+        if append_hass_change(epochs, states, epoch, state) and changed_from is None:
+            changed_from = datetime.fromtimestamp(epoch, timezone.utc)
+
+    # drop history before the window, keeping the state in effect at its start
+    first_kept = max(0, bisect_right(epochs, query_start.timestamp()) - 1)
+    return (
+        np.frombuffer(epochs, dtype=np.float64)[first_kept:],
+        states[first_kept:],
+    ), changed_from
+
+
+def merge_fitbit_data(retained, fetched, query_start):
+    # a date has changed when its payload differs from the one we already hold
+    merged = {
+        query_date: response
+        for query_date, response in retained.items()
+        if query_date >= query_start.date().isoformat()
+    }
+    changed_dates = []
+    for query_date, response in fetched.items():
+        if merged.get(query_date) != response:
+            changed_dates.append(query_date)
+        merged[query_date] = response
+    if len(changed_dates):
+        changed_from = datetime.fromisoformat(min(changed_dates)).replace(
+            tzinfo=timezone.utc
+        )
     else:
-        # start counting time
-        time_map = {
-            changes_before_start[-1]["state"]: changes_in_bucket[0]["last_changed"]
-            - bucket_start
-        }
-        for row in changes_in_bucket:
-            if changes_in_bucket.index(row) + 1 == len(changes_in_bucket):
-                # last in list, duration extends to end of bucket
-                duration = bucket_end - row["last_changed"]
-            else:
-                # not last, duration extends to next change
-                duration = (
-                    changes_in_bucket[changes_in_bucket.index(row) + 1]["last_changed"]
-                    - row["last_changed"]
-                )
-            # add to counter
-            if not row["state"] in time_map:
-                time_map.update({row["state"]: duration})
-            else:
-                time_map[row["state"]] += duration
-        return time_map
+        changed_from = None
+    return dict(sorted(merged.items())), changed_from
+
+
+def state_data_to_bucket_durations(bucket_starts, bucket_ends, state_data, last_state):
+    # one sweep over the sorted state changes, buckets must be sorted and disjoint
+    changes = list(zip(state_data[0].tolist(), state_data[1]))
+    change_index = 0
+    current_state = last_state
+    bucket_summaries = []
+    for bucket_start, bucket_end in zip(
+        np.asarray(bucket_starts, dtype=np.float64).tolist(),
+        np.asarray(bucket_ends, dtype=np.float64).tolist(),
+    ):
+        # catch up to the state in effect at the start of the bucket
+        while change_index < len(changes) and changes[change_index][0] <= bucket_start:
+            current_state = changes[change_index][1]
+            change_index += 1
+
+        # split the bucket into segments at each state change
+        segments = []
+        segment_start = bucket_start
+        while change_index < len(changes) and changes[change_index][0] < bucket_end:
+            segments.append((current_state, changes[change_index][0] - segment_start))
+            segment_start, current_state = changes[change_index]
+            change_index += 1
+        segments.append((current_state, bucket_end - segment_start))
+
+        # accumulate durations and analog statistics for the bucket
+        durations = {}
+        weighted_sum = 0.0
+        numeric_seconds = 0.0
+        minimum = None
+        maximum = None
+        for state, seconds in segments:
+            if seconds <= 0:
+                continue
+            durations[state] = durations.get(state, 0.0) + seconds
+            try:
+                value = float(state)
+            except (TypeError, ValueError):
+                # None, unavailable, unknown, etc.
+                continue
+            weighted_sum += value * seconds
+            numeric_seconds += seconds
+            minimum = value if minimum is None else min(minimum, value)
+            maximum = value if maximum is None else max(maximum, value)
+        bucket_summaries.append(
+            {
+                "durations": durations,
+                "mean": weighted_sum / numeric_seconds if numeric_seconds else None,
+                "minimum": minimum,
+                "maximum": maximum,
+            }
+        )
+    return bucket_summaries
 
 
-def get_predominant_state(bucket_start, bucket_end, state_data, last_state):
-    time_map = state_data_to_bucket_durations(
-        bucket_start, bucket_end, state_data, last_state
-    )
-    return max(time_map, key=time_map.get)
+def get_predominant_state(bucket_summaries):
+    return [
+        max(summary["durations"], key=summary["durations"].get)
+        for summary in bucket_summaries
+    ]
 
 
-def get_state_duration_hours(
-    bucket_start, bucket_end, state_data, last_state, select_states
-):
-    time_map = state_data_to_bucket_durations(
-        bucket_start, bucket_end, state_data, last_state
-    )
-    duration_sum = sum(
-        [
-            time_map[state].total_seconds()
-            for state in time_map
-            if state in select_states
-        ]
-    )
-    return duration_sum / 3600
+def get_state_duration_hours(bucket_summaries, select_states):
+    return [
+        sum(
+            [
+                seconds
+                for state, seconds in summary["durations"].items()
+                if state in select_states
+            ]
+        )
+        / 3600
+        for summary in bucket_summaries
+    ]
 
 
-def get_state_sensor_analog(
-    bucket_start, bucket_end, state_data, last_state, analog_aggregate_method
-):
-    time_map = state_data_to_bucket_durations(
-        bucket_start, bucket_end, state_data, last_state
-    )
-    time_map.pop(None, None)
-    time_map.pop("unavailable", None)
-    if len(time_map) == 0:
-        return None
-    elif analog_aggregate_method == "mean":
-        return sum(
-            [float(key) * value.total_seconds() for key, value in time_map.items()]
-        ) / sum([value.total_seconds() for key, value in time_map.items()])
-    elif analog_aggregate_method == "minimum":
-        return float(min(time_map.keys()))
-    elif analog_aggregate_method == "maximum":
-        return float(max(time_map.keys()))
-    else:
+def get_state_sensor_analog(bucket_summaries, analog_aggregate_method):
+    if analog_aggregate_method not in ["mean", "minimum", "maximum"]:
         raise Exception("Aggregate method not supported.")
+    return [summary[analog_aggregate_method] for summary in bucket_summaries]
 
 
-def get_fitbit_steps_sum(bucket_start, bucket_end, data_fitbit):
-    steps_list = []
-    for query_date in data_fitbit:
-        for row in data_fitbit[query_date]["activities-steps-intraday"]["dataset"]:
-            row_time = datetime.fromisoformat(query_date + "T" + row["time"] + "Z")
-            if bucket_start < row_time <= bucket_end:
-                steps_list.append(row["value"])
-    return sum(steps_list)
+def get_bucket_bounds(table_data):
+    bucket_starts = np.array([row["start_time"].timestamp() for row in table_data])
+    bucket_ends = np.array([row["end_time"].timestamp() for row in table_data])
+    return bucket_starts, bucket_ends
 
 
-def get_fitbit_heart_mean(bucket_start, bucket_end, data_fitbit):
-    hr_list = []
+def parse_fitbit_intraday(data_fitbit, dataset_key):
+    # flatten every queried date into sorted epoch/value arrays, parsed once
+    timestamps = []
+    values = []
     for query_date in data_fitbit:
-        for row in data_fitbit[query_date]["activities-heart-intraday"]["dataset"]:
-            row_time = datetime.fromisoformat(query_date + "T" + row["time"] + "Z")
-            if bucket_start < row_time <= bucket_end:
-                hr_list.append(row["value"])
-    if len(hr_list):
-        return float(np.mean(hr_list))
+        dataset = data_fitbit[query_date][dataset_key]["dataset"]
+        timestamps.extend([query_date + "T" + row["time"] for row in dataset])
+        values.extend([row["value"] for row in dataset])
+    epochs = np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+    values = np.array(values, dtype=np.float64)
+    order = np.argsort(epochs, kind="stable")
+    return epochs[order], values[order]
+
+
+def get_intraday_bucket_slices(bucket_starts, bucket_ends, intraday):
+    # samples in (bucket_start, bucket_end] are values[lower:upper]
+    epochs, _ = intraday
+    lower = np.searchsorted(epochs, bucket_starts, side="right")
+    upper = np.searchsorted(epochs, bucket_ends, side="right")
+    return lower, np.maximum(upper, lower)
+
+
+def build_fitbit_rollup(intraday, query_start, query_end, width_minutes, histogram):
+    # partial aggregates over a base grid aligned to midnight, which every
+    # table whose durations and offsets are multiples of the width can reuse
+    epochs, values = intraday
+    origin = int(
+        query_start.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    )
+    width = width_minutes * 60
+    bucket_count = -(-(int(query_end.timestamp()) - origin) // width)
+
+    # samples in (start, end] of base bucket i
+    base_index = (epochs - origin - 1) // width
+    in_grid = (base_index >= 0) & (base_index < bucket_count)
+    base_index = base_index[in_grid]
+    values = values[in_grid]
+    rollup = {"origin": origin, "width": width, "bucket_count": bucket_count}
+    if not histogram:
+        counts = np.bincount(base_index, minlength=bucket_count)
+        sums = np.bincount(base_index, weights=values, minlength=bucket_count)
+        rollup["counts"] = np.concatenate(([0], np.cumsum(counts)))
+        rollup["sums"] = np.concatenate(([0], np.cumsum(sums)))
     else:
+        # one bin per integer value, exact for heart rates
+        minimum = int(np.floor(values.min())) if len(values) else 0
+        bins = np.clip(np.rint(values).astype(np.int64) - minimum, 0, 511)
+        bin_count = int(bins.max()) + 1 if len(bins) else 1
+        counts = np.bincount(
+            base_index * bin_count + bins, minlength=bucket_count * bin_count
+        ).reshape(bucket_count, bin_count)
+        rollup["minimum"] = minimum
+        rollup["histogram"] = np.concatenate(
+            (np.zeros((1, bin_count), dtype=np.int64), np.cumsum(counts, axis=0))
+        )
+    return rollup
+
+
+def build_fitbit_rollups(
+    table_config, metric_plan, intraday_fitbit, query_start, query_end
+):
+    # the tables each rollup has to serve
+    rollup_tables = {}
+    for table_name, metric_groups in metric_plan.items():
+        for (group_kind, fitbit_type), metrics in metric_groups.items():
+            if group_kind != "fitbit_intraday":
+                continue
+            for metric_specs in metrics.values():
+                if metric_specs["aggregate"] == "fitbit_heart_percentile":
+                    rollup_key = ("histogram", fitbit_type)
+                else:
+                    rollup_key = ("totals", fitbit_type)
+                rollup_tables.setdefault(rollup_key, set()).add(table_name)
+
+    rollups = {}
+    for (rollup_kind, fitbit_type), table_names in rollup_tables.items():
+        # the finest grid every one of these tables can be merged from
+        width_minutes = math.gcd(
+            *[
+                table_config[table_name][key]
+                for table_name in table_names
+                for key in ["duration_minutes", "align_offset_minutes"]
+            ]
+        )
+        rollups[(rollup_kind, fitbit_type)] = build_fitbit_rollup(
+            intraday_fitbit[fitbit_type],
+            query_start,
+            query_end,
+            width_minutes,
+            rollup_kind == "histogram",
+        )
+    return rollups
+
+
+def get_rollup_slices(rollup, bucket_starts, bucket_ends):
+    # base buckets lower:upper make up each bucket, or None if they don't line up
+    lower = (np.asarray(bucket_starts) - rollup["origin"]) / rollup["width"]
+    upper = (np.asarray(bucket_ends) - rollup["origin"]) / rollup["width"]
+    if not (
+        np.all(lower == np.floor(lower))
+        and np.all(upper == np.floor(upper))
+        and np.all(lower >= 0)
+        and np.all(upper <= rollup["bucket_count"])
+    ):
         return None
+    return lower.astype(np.int64), upper.astype(np.int64)
 
 
-def get_fitbit_heart_percentile(bucket_start, bucket_end, data_fitbit, percentile):
-    hr_list = []
-    for query_date in data_fitbit:
-        for row in data_fitbit[query_date]["activities-heart-intraday"]["dataset"]:
-            row_time = datetime.fromisoformat(query_date + "T" + row["time"] + "Z")
-            if bucket_start < row_time <= bucket_end:
-                hr_list.append(row["value"])
-    if len(hr_list):
-        return float(np.percentile(hr_list, percentile))
+def get_bucket_totals(bucket_starts, bucket_ends, intraday, rollup=None):
+    slices = None
+    if rollup is not None:
+        slices = get_rollup_slices(rollup, bucket_starts, bucket_ends)
+    if slices is not None:
+        lower, upper = slices
+        counts = rollup["counts"][upper] - rollup["counts"][lower]
+        sums = rollup["sums"][upper] - rollup["sums"][lower]
     else:
-        return None
+        lower, upper = get_intraday_bucket_slices(bucket_starts, bucket_ends, intraday)
+        cumulative = np.concatenate(([0], np.cumsum(intraday[1])))
+        counts = upper - lower
+        sums = cumulative[upper] - cumulative[lower]
+    return counts, sums
+
+
+def get_fitbit_steps_sum(bucket_starts, bucket_ends, intraday, rollup=None):
+    _, sums = get_bucket_totals(bucket_starts, bucket_ends, intraday, rollup)
+    return [int(round(value)) for value in sums]
+
+
+def get_fitbit_heart_mean(bucket_starts, bucket_ends, intraday, rollup=None):
+    counts, sums = get_bucket_totals(bucket_starts, bucket_ends, intraday, rollup)
+    return [
+        float(sums[i] / counts[i]) if counts[i] else None for i in range(len(counts))
+    ]
+
+
+def get_rollup_percentiles(rollup, lower, upper, percentiles):
+    histograms = rollup["histogram"][upper] - rollup["histogram"][lower]
+    cumulative = np.cumsum(histograms, axis=1)
+    counts = cumulative[:, -1]
+
+    # linear interpolation between closest ranks, read from the histograms
+    results = {}
+    for percentile in percentiles:
+        position = (np.maximum(counts, 1) - 1) * (percentile / 100)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, np.maximum(counts, 1) - 1)
+        fraction = position - below
+        value_below = (cumulative <= below[:, None]).sum(axis=1)
+        value_above = (cumulative <= above[:, None]).sum(axis=1)
+        values = (
+            rollup["minimum"] + value_below + (value_above - value_below) * fraction
+        )
+        results[percentile] = [
+            float(values[i]) if counts[i] else None for i in range(len(counts))
+        ]
+    return results
+
+
+def get_fitbit_heart_percentiles(
+    bucket_starts, bucket_ends, intraday, percentiles, rollup=None
+):
+    if rollup is not None:
+        slices = get_rollup_slices(rollup, bucket_starts, bucket_ends)
+        if slices is not None:
+            return get_rollup_percentiles(rollup, *slices, percentiles)
+
+    lower, upper = get_intraday_bucket_slices(bucket_starts, bucket_ends, intraday)
+    counts = upper - lower
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # gather every bucket's samples and sort them within their bucket at once
+    bucket_ids = np.repeat(np.arange(len(counts)), counts)
+    sample_index = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - lower, counts)
+    samples = intraday[1][sample_index]
+    samples = samples[np.lexsort((samples, bucket_ids))]
+    if not len(samples):
+        return {percentile: [None] * len(counts) for percentile in percentiles}
+
+    # linear interpolation between closest ranks, same as np.percentile
+    results = {}
+    for percentile in percentiles:
+        position = (np.maximum(counts, 1) - 1) * (percentile / 100)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, np.maximum(counts, 1) - 1)
+        fraction = position - below
+        value_below = samples[np.minimum(offsets[:-1] + below, len(samples) - 1)]
+        value_above = samples[np.minimum(offsets[:-1] + above, len(samples) - 1)]
+        values = value_below + (value_above - value_below) * fraction
+        results[percentile] = [
+            float(values[i]) if counts[i] else None for i in range(len(counts))
+        ]
+    return results
+
+
+def get_fitbit_heart_percentile(
+    bucket_starts, bucket_ends, intraday, percentile, rollup=None
+):
+    return get_fitbit_heart_percentiles(
+        bucket_starts, bucket_ends, intraday, [percentile], rollup
+    )[percentile]
 
 
 def get_fitbit_heart_rmssd(bucket_start, bucket_end, data_fitbit):
@@ -305,68 +1024,140 @@ def get_fitbit_heart_rmssd(bucket_start, bucket_end, data_fitbit):
         return None
 
 
-def get_fitbit_sleep(bucket_start, bucket_end, data_fitbit, fitbit_sleep_item):
-    for query_date, query_data in data_fitbit.items():
-        if query_date == bucket_start.date().isoformat() and len(query_data["sleep"]):
-            # Get the longest sleep item based on minutesAsleep
-            sleep_item = max(
-                query_data["sleep"], key=lambda x: x.get("minutesAsleep", 0)
-            )
-            if fitbit_sleep_item == "hours_inbed":
-                return sleep_item["timeInBed"] / 60
-            elif fitbit_sleep_item == "hours_asleep":
-                return sleep_item["minutesAsleep"] / 60
-            elif fitbit_sleep_item == "hours_deep":
-                return sleep_item["levels"]["summary"]["deep"]["minutes"] / 60
-            elif fitbit_sleep_item == "hours_light":
-                return sleep_item["levels"]["summary"]["light"]["minutes"] / 60
-            elif fitbit_sleep_item == "hours_rem":
-                return sleep_item["levels"]["summary"]["rem"]["minutes"] / 60
-            elif fitbit_sleep_item == "hours_wake":
-                return sleep_item["levels"]["summary"]["wake"]["minutes"] / 60
-            elif fitbit_sleep_item == "time_start":
-                return datetime.fromisoformat(sleep_item["startTime"] + "Z")
-            elif fitbit_sleep_item == "time_end":
-                return datetime.fromisoformat(sleep_item["endTime"] + "Z")
-            raise Exception("Sleep property not supported.")
-    print("Warning: No sleep entry found for date", bucket_start.date().isoformat())
-    return None
+def get_longest_sleep_items(data_fitbit):
+    # the longest sleep item of each date, based on minutesAsleep
+    return {
+        query_date: max(query_data["sleep"], key=lambda x: x.get("minutesAsleep", 0))
+        for query_date, query_data in data_fitbit.items()
+        if len(query_data["sleep"])
+    }
+
+
+def get_fitbit_sleep(sleep_item, fitbit_sleep_item):
+    if fitbit_sleep_item == "hours_inbed":
+        return sleep_item["timeInBed"] / 60
+    elif fitbit_sleep_item == "hours_asleep":
+        return sleep_item["minutesAsleep"] / 60
+    elif fitbit_sleep_item == "hours_deep":
+        return sleep_item["levels"]["summary"]["deep"]["minutes"] / 60
+    elif fitbit_sleep_item == "hours_light":
+        return sleep_item["levels"]["summary"]["light"]["minutes"] / 60
+    elif fitbit_sleep_item == "hours_rem":
+        return sleep_item["levels"]["summary"]["rem"]["minutes"] / 60
+    elif fitbit_sleep_item == "hours_wake":
+        return sleep_item["levels"]["summary"]["wake"]["minutes"] / 60
+    elif fitbit_sleep_item == "time_start":
+        return datetime.fromisoformat(sleep_item["startTime"] + "Z")
+    elif fitbit_sleep_item == "time_end":
+        return datetime.fromisoformat(sleep_item["endTime"] + "Z")
+    raise Exception("Sleep property not supported.")
+
+
+def get_bucket_grid(query_start, query_end, bucket_width, align_offset):
+    # first whole bucket starting at or after query_start, and how many fit
+    grid_start = (
+        query_start.replace(hour=0, minute=0, second=0, microsecond=0) + align_offset
+    )
+    if grid_start < query_start:
+        steps, remainder = divmod(query_start - grid_start, bucket_width)
+        grid_start += bucket_width * (steps + 1 if remainder else steps)
+    bucket_count = max(0, (query_end - grid_start) // bucket_width)
+    return grid_start, bucket_count
 
 
 def get_buckets(query_start, query_end, bucket_width, align_offset):
-    buckets = []
-    bucket_time = (
-        query_start.replace(hour=0, minute=0, second=0, microsecond=0) + align_offset
+    grid_start, bucket_count = get_bucket_grid(
+        query_start, query_end, bucket_width, align_offset
     )
-    while bucket_time < query_start:
-        bucket_time += bucket_width
-    bucket_time += bucket_width
-    while bucket_time <= query_end:
-        buckets.append(
-            {
-                "start_time": bucket_time - bucket_width,
-                "end_time": bucket_time,
-            }
+    return [
+        {
+            "start_time": grid_start + bucket_width * i,
+            "end_time": grid_start + bucket_width * (i + 1),
+        }
+        for i in range(bucket_count)
+    ]
+
+
+def is_partitioned_table(conn, table):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+        (table,),
+    )
+    partitioned = cursor.fetchone()[0] > 0
+    cursor.close()
+    return partitioned
+
+
+def get_partition_bounds(range_start, range_end):
+    # monthly partitions in utc covering every start_time in the range
+    partition_start = range_start.astimezone(timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    partition_bounds = []
+    while partition_start < range_end:
+        partition_end = (partition_start + timedelta(days=32)).replace(day=1)
+        partition_bounds.append((partition_start, partition_end))
+        partition_start = partition_end
+    return partition_bounds
+
+
+def create_partitions(conn, table, range_start, range_end):
+    # left uncommitted so the caller's insert or migration commits it
+    cursor = conn.cursor()
+    for partition_start, partition_end in get_partition_bounds(range_start, range_end):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_{partition_start:%Y_%m} "
+            f"PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+            (partition_start, partition_end),
         )
-        bucket_time += bucket_width
-    return buckets
+    cursor.close()
 
 
-def insert_new_buckets(conn, table, data):
+def insert_new_buckets(conn, table, query_start, query_end, bucket_width, align_offset):
+    grid_start, bucket_count = get_bucket_grid(
+        query_start, query_end, bucket_width, align_offset
+    )
+    if bucket_count == 0:
+        return
+    grid_end = grid_start + bucket_width * bucket_count
     cursor = conn.cursor()
-    statement = f"INSERT INTO {table} (%s) VALUES %s ON CONFLICT DO NOTHING"
-    for row in data:
-        cursor.execute(statement, (AsIs(",".join(row.keys())), tuple(row.values())))
+
+    # skip creation entirely when the grid already covers the window
+    cursor.execute(
+        f"SELECT count(*) FROM {table} WHERE start_time >= %s AND end_time <= %s",
+        (grid_start, grid_end),
+    )
+    if cursor.fetchone()[0] >= bucket_count:
+        cursor.close()
+        return
+
+    if is_partitioned_table(conn, table):
+        create_partitions(conn, table, grid_start, grid_end)
+
+    # build the whole grid server-side in one statement
+    cursor.execute(
+        f"INSERT INTO {table} (start_time, end_time) "
+        "SELECT bucket_start, bucket_start + %s "
+        "FROM generate_series(%s::timestamptz, %s::timestamptz, %s) AS bucket_start "
+        "ON CONFLICT DO NOTHING",
+        (bucket_width, grid_start, grid_end - bucket_width, bucket_width),
+    )
     conn.commit()
     cursor.close()
     return
 
 
-def get_table_data(conn, table, query_start, query_end):
+def get_table_data(conn, table, query_start, query_end, columns=()):
+    # only the bucket bounds and the given metric columns are read, and the
+    # window is bounded on start_time so partitioned tables are pruned
+    select_columns = ", ".join(["start_time", "end_time", *columns])
     cursor = conn.cursor()
     cursor.execute(
-        f"SELECT * FROM {table} WHERE start_time > %s AND end_time < %s ORDER BY end_time",
-        (query_start.isoformat(), query_end.isoformat()),
+        f"SELECT {select_columns} FROM {table} "
+        "WHERE start_time >= %s AND start_time < %s AND end_time <= %s "
+        "ORDER BY end_time",
+        (query_start.isoformat(), query_end.isoformat(), query_end.isoformat()),
     )
     result = cursor.fetchall()
     cursor.close()
@@ -376,141 +1167,1609 @@ def get_table_data(conn, table, query_start, query_end):
     ]
 
 
-def update_data(conn, table, column, data):
-    # data = {key: value for key, value in data.items() if value is not None}
-    print("Updating", len(data), "rows in", table, column)
+def value_changed(stored_value, new_value):
+    # decimals and reals come back rounded differently than the floats that
+    # produced them, so numbers only count as changed beyond a small tolerance
+    if stored_value is None or new_value is None:
+        return stored_value is not new_value
+    if isinstance(new_value, (int, float, np.number)) and not isinstance(
+        new_value, bool
+    ):
+        return not math.isclose(
+            float(stored_value), float(new_value), rel_tol=1e-6, abs_tol=1e-6
+        )
+    return stored_value != new_value
+
+
+def get_column_types(conn, table):
+    # resolved through the search path, so account schemas and temp tables
+    # both find their own columns
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+        (table,),
+    )
+    result = cursor.fetchall()
+    cursor.close()
+    return {column_name: data_type for column_name, data_type in result}
+
+
+def update_data(conn, table, data):
+    # data maps each column to {row start_time: value}, written as one set-based
+    # update per group of rows that share the same set of columns
+    row_columns = {}
+    for column, column_data in data.items():
+        for row_start in column_data:
+            row_columns.setdefault(row_start, []).append(column)
+    row_groups = {}
+    for row_start, columns in row_columns.items():
+        row_groups.setdefault(tuple(columns), []).append(row_start)
+    changed_columns = [column for column in data if len(data[column])]
+    print("Updating", len(row_columns), "rows in", table, ",".join(changed_columns))
+    record_run_metric("sandiego_rows_written", {"table": table}, len(row_columns), True)
+    if not row_groups:
+        return
+
+    column_types = get_column_types(conn, table)
     cursor = conn.cursor()
-    statement = f"UPDATE {table} SET {column} = %s WHERE id = %s;"
-    for key, value in data.items():
-        cursor.execute(statement, (value, key))
+    for columns, row_starts in row_groups.items():
+        assignments = ", ".join(
+            [f"{column} = v.{column}::{column_types[column]}" for column in columns]
+        )
+        # the literal range lets partitioned tables prune to the touched months
+        row_range = cursor.mogrify(
+            "t.start_time BETWEEN %s AND %s", (min(row_starts), max(row_starts))
+        ).decode()
+        statement = (
+            f"UPDATE {table} AS t SET {assignments} FROM (VALUES %s) "
+            f"AS v (start_time, {', '.join(columns)}) "
+            f"WHERE t.start_time = v.start_time AND {row_range}"
+        )
+        values = [
+            (row_start, *[data[column][row_start] for column in columns])
+            for row_start in row_starts
+        ]
+        execute_values(cursor, statement, values, page_size=len(values))
     conn.commit()
     cursor.close()
     return
 
 
-def main():
-    print("Starting new run at", datetime.now().isoformat())
+def get_bucket_start(epoch, table_specs):
+    # bucket widths divide a day, so the grid is the same from any midnight
+    width = table_specs["duration_minutes"] * 60
+    offset = table_specs["align_offset_minutes"] * 60
+    return offset + (epoch - offset) // width * width
+
+
+def copy_bucket_data(conn, table_name, table_specs, columns, buckets, overwrite):
+    # buckets maps each bucket start epoch to {column: value}, bulk loaded into
+    # a staging table and then merged into the real one
+    if not len(buckets):
+        return
+    width = table_specs["duration_minutes"] * 60
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for bucket_start, values in sorted(buckets.items()):
+        writer.writerow(
+            [
+                datetime.fromtimestamp(bucket_start, timezone.utc).isoformat(),
+                datetime.fromtimestamp(bucket_start + width, timezone.utc).isoformat(),
+                *["" if values.get(c) is None else values[c] for c in columns],
+            ]
+        )
+    buffer.seek(0)
 
-    conn = get_database_connection()
+    cursor = conn.cursor()
+    if is_partitioned_table(conn, table_name):
+        create_partitions(
+            conn,
+            table_name,
+            datetime.fromtimestamp(min(buckets), timezone.utc),
+            datetime.fromtimestamp(max(buckets) + 1, timezone.utc),
+        )
+    select_columns = ", ".join(["start_time", "end_time", *columns])
+    cursor.execute(
+        f"CREATE TEMP TABLE bucket_staging AS SELECT {select_columns} "
+        f"FROM {table_name} WITH NO DATA"
+    )
+    cursor.copy_expert(
+        f"COPY bucket_staging ({select_columns}) FROM STDIN WITH (FORMAT csv)", buffer
+    )
+    if overwrite:
+        assignments = ", ".join([f"{c} = EXCLUDED.{c}" for c in columns])
+    else:
+        assignments = ", ".join(
+            [f"{c} = COALESCE({table_name}.{c}, EXCLUDED.{c})" for c in columns]
+        )
+    cursor.execute(
+        f"INSERT INTO {table_name} ({select_columns}) "
+        f"SELECT {select_columns} FROM bucket_staging "
+        f"ON CONFLICT (start_time) DO UPDATE SET {assignments}"
+    )
+    print("Imported", cursor.rowcount, "rows into", table_name)
+    cursor.execute("DROP TABLE bucket_staging")
+    conn.commit()
+    cursor.close()
+
+
+def get_rolling_windows(values, window_buckets, end_indexes):
+    # the window_buckets values ending at each index, padded before the start
+    padded = np.concatenate((np.full(window_buckets - 1, np.nan), values))
+    return np.lib.stride_tricks.sliding_window_view(padded, window_buckets)[end_indexes]
+
+
+def get_rolling_stats(values, window_buckets, end_indexes):
+    windows = get_rolling_windows(values, window_buckets, end_indexes)
+    counts = (~np.isnan(windows)).sum(axis=1)
+    stats = {
+        "sample_count": counts,
+        "mean": np.full(len(end_indexes), np.nan),
+        "pct_10": np.full(len(end_indexes), np.nan),
+        "pct_50": np.full(len(end_indexes), np.nan),
+        "pct_90": np.full(len(end_indexes), np.nan),
+    }
+    filled = counts > 0
+    if filled.any():
+        stats["mean"][filled] = np.nanmean(windows[filled], axis=1)
+        (
+            stats["pct_10"][filled],
+            stats["pct_50"][filled],
+            stats["pct_90"][filled],
+        ) = np.nanpercentile(windows[filled], [10, 50, 90], axis=1)
+    return stats
+
+
+def get_rolling_correlation(values_x, values_y, window_buckets, end_indexes):
+    # sums over the buckets where both metrics are present, kept so dashboards
+    # can combine windows without rescanning
+    both = ~np.isnan(values_x) & ~np.isnan(values_y)
+    x = np.where(both, values_x, 0.0)
+    y = np.where(both, values_y, 0.0)
+    sums = {
+        "sample_count": both.astype(np.float64),
+        "sum_x": x,
+        "sum_y": y,
+        "sum_xx": x * x,
+        "sum_yy": y * y,
+        "sum_xy": x * y,
+    }
+    stats = {
+        name: np.nansum(
+            get_rolling_windows(column, window_buckets, end_indexes), axis=1
+        )
+        for name, column in sums.items()
+    }
+    n = stats["sample_count"]
+    covariance = n * stats["sum_xy"] - stats["sum_x"] * stats["sum_y"]
+    variance = (n * stats["sum_xx"] - stats["sum_x"] ** 2) * (
+        n * stats["sum_yy"] - stats["sum_y"] ** 2
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["correlation"] = np.where(
+            (n >= 2) & (variance > 0), covariance / np.sqrt(variance), np.nan
+        )
+    stats["sample_count"] = n.astype(np.int64)
+    return stats
 
+
+def upsert_rolling_rows(conn, table, key_columns, stat_columns, rows):
+    if not len(rows):
+        return
+    columns = key_columns + stat_columns
+    cursor = conn.cursor()
+    execute_values(
+        cursor,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s "
+        f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET "
+        + ", ".join([f"{column} = EXCLUDED.{column}" for column in stat_columns]),
+        rows,
+        page_size=len(rows),
+    )
+    conn.commit()
+    cursor.close()
+
+
+def update_rolling_summaries(conn, table_name, table_specs, table_updates):
+    # rolling windows over the table, only recomputed for windows that contain
+    # a bucket whose value changed in this run
+    summary_specs = table_specs.get("summaries")
+    if not summary_specs:
+        return
+    summary_metrics = summary_specs.get("metrics", [])
+    correlations = summary_specs.get("correlations", [])
+    changed_starts = {
+        metric_name: sorted(row_values)
+        for metric_name, row_values in table_updates.items()
+        if len(row_values)
+        and (
+            metric_name in summary_metrics
+            or any(metric_name in pair for pair in correlations)
+        )
+    }
+    if not len(changed_starts):
+        return
+
+    # read every bucket a recomputed window can cover, once for all summaries
+    bucket_width = timedelta(minutes=table_specs["duration_minutes"])
+    longest_window = max(summary_specs["rolling_buckets"])
+    range_start = min(starts[0] for starts in changed_starts.values())
+    range_start -= bucket_width * (longest_window - 1)
+    range_end = max(starts[-1] for starts in changed_starts.values())
+    range_end += bucket_width * (longest_window - 1)
+    source_metrics = sorted(
+        set(summary_metrics) | {metric for pair in correlations for metric in pair}
+    )
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT start_time, end_time, {', '.join(source_metrics)} FROM {table_name} "
+        "WHERE start_time >= %s AND start_time <= %s ORDER BY start_time",
+        (range_start, range_end),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+
+    # place the rows on a regular grid so a window is a fixed number of slots
+    bucket_count = (range_end - range_start) // bucket_width + 1
+    present = np.zeros(bucket_count, dtype=bool)
+    end_times = [None] * bucket_count
+    values = {metric: np.full(bucket_count, np.nan) for metric in source_metrics}
+    for row in rows:
+        index = (row[0] - range_start) // bucket_width
+        present[index] = True
+        end_times[index] = row[1]
+        for metric, value in zip(source_metrics, row[2:]):
+            if value is not None:
+                values[metric][index] = float(value)
+
+    def get_end_indexes(starts, window_buckets):
+        first = (starts[0] - range_start) // bucket_width
+        last = (starts[-1] - range_start) // bucket_width + window_buckets - 1
+        end_indexes = np.arange(first, min(last, bucket_count - 1) + 1)
+        return end_indexes[present[end_indexes]]
+
+    summary_rows = []
+    correlation_rows = []
+    for window_buckets in summary_specs["rolling_buckets"]:
+        for metric in summary_metrics:
+            if metric not in changed_starts:
+                continue
+            end_indexes = get_end_indexes(changed_starts[metric], window_buckets)
+            stats = get_rolling_stats(values[metric], window_buckets, end_indexes)
+            for i, end_index in enumerate(end_indexes.tolist()):
+                summary_rows.append(
+                    (
+                        table_name,
+                        metric,
+                        window_buckets,
+                        end_times[end_index],
+                        *[
+                            None if np.isnan(stats[name][i]) else float(stats[name][i])
+                            for name in ["mean", "pct_10", "pct_50", "pct_90"]
+                        ],
+                        int(stats["sample_count"][i]),
+                    )
+                )
+        for metric_x, metric_y in correlations:
+            starts = sorted(
+                changed_starts.get(metric_x, []) + changed_starts.get(metric_y, [])
+            )
+            if not len(starts):
+                continue
+            end_indexes = get_end_indexes(starts, window_buckets)
+            stats = get_rolling_correlation(
+                values[metric_x], values[metric_y], window_buckets, end_indexes
+            )
+            for i, end_index in enumerate(end_indexes.tolist()):
+                correlation_rows.append(
+                    (
+                        table_name,
+                        metric_x,
+                        metric_y,
+                        window_buckets,
+                        end_times[end_index],
+                        int(stats["sample_count"][i]),
+                        *[
+                            float(stats[name][i])
+                            for name in ["sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"]
+                        ],
+                        (
+                            None
+                            if np.isnan(stats["correlation"][i])
+                            else float(stats["correlation"][i])
+                        ),
+                    )
+                )
+
+    upsert_rolling_rows(
+        conn,
+        "rolling_summaries",
+        ["source_table", "metric_name", "window_buckets", "end_time"],
+        ["mean", "pct_10", "pct_50", "pct_90", "sample_count"],
+        summary_rows,
+    )
+    upsert_rolling_rows(
+        conn,
+        "rolling_correlations",
+        ["source_table", "metric_x", "metric_y", "window_buckets", "end_time"],
+        ["sample_count", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy", "correlation"],
+        correlation_rows,
+    )
+    print(
+        "Updated",
+        len(summary_rows),
+        "rolling summaries and",
+        len(correlation_rows),
+        "rolling correlations for",
+        table_name,
+    )
+
+
+# computed cells are appended to a local sqlite spool and drained to postgres
+# by a background writer, so runs never wait on or fail with the database
+spool_state = {
+    "wake": threading.Event(),
+}
+
+
+def get_spool_connection():
+    spool_file = get_account_path("SANDIEGO_SPOOL_FILE", "spool.sqlite3")
+    connection = sqlite3.connect(spool_file, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # the latest value of every cell, pending until written to postgres
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS cells (table_name TEXT, start_time REAL, "
+        "column_name TEXT, value BLOB, sequence INTEGER, pending INTEGER, "
+        "PRIMARY KEY (table_name, start_time, column_name))"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS cells_pending "
+        "ON cells (pending, table_name, start_time)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS cells_sequence ON cells (sequence)")
+    return connection
+
+
+def get_spool_table_data(table_name, table_specs, query_start, query_end, columns):
+    # the bucket grid with the last spooled value of each cell stands in for
+    # the stored rows, so changes are detected without reading postgres
+    table_data = get_buckets(
+        query_start,
+        query_end,
+        timedelta(minutes=table_specs["duration_minutes"]),
+        timedelta(minutes=table_specs["align_offset_minutes"]),
+    )
+    for row in table_data:
+        row.update(dict.fromkeys(columns))
+    if not len(table_data):
+        return table_data
+    rows = {row["start_time"].timestamp(): row for row in table_data}
+    connection = get_spool_connection()
+    result = connection.execute(
+        "SELECT start_time, column_name, value FROM cells "
+        "WHERE table_name = ? AND start_time >= ? AND start_time <= ?",
+        (table_name, min(rows), max(rows)),
+    ).fetchall()
+    connection.close()
+    for start_epoch, column, value in result:
+        if start_epoch in rows and column in columns:
+            rows[start_epoch][column] = pickle.loads(value)
+    return table_data
+
+
+def append_spool(table_name, table_updates):
+    cells = [
+        (table_name, row_start.timestamp(), column, pickle.dumps(value))
+        for column, column_data in table_updates.items()
+        for row_start, value in column_data.items()
+    ]
+    print("Spooling", len(cells), "cells for", table_name)
+    if not len(cells):
+        return
+    connection = get_spool_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        sequence = connection.execute(
+            "SELECT coalesce(max(sequence), 0) + 1 FROM cells"
+        ).fetchone()[0]
+        connection.executemany(
+            "INSERT INTO cells VALUES (?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT (table_name, start_time, column_name) DO UPDATE SET "
+            "value = excluded.value, sequence = excluded.sequence, pending = 1",
+            [cell + (sequence,) for cell in cells],
+        )
+    connection.close()
+    spool_state["wake"].set()
+
+
+def drain_spool(conn, table_config):
+    batch_cells = int(os.environ.get("SANDIEGO_SPOOL_BATCH_CELLS", "100000"))
+    connection = get_spool_connection()
+    for table_name, table_specs in table_config.items():
+        bucket_width = timedelta(minutes=table_specs["duration_minutes"])
+        while True:
+            result = connection.execute(
+                "SELECT start_time, column_name, value, sequence FROM cells "
+                "WHERE pending = 1 AND table_name = ? ORDER BY start_time LIMIT ?",
+                (table_name, batch_cells),
+            ).fetchall()
+            if not len(result):
+                break
+            table_updates = {}
+            for start_epoch, column, value, _ in result:
+                row_start = datetime.fromtimestamp(start_epoch, timezone.utc)
+                table_updates.setdefault(column, {})[row_start] = pickle.loads(value)
+            batch_start = datetime.fromtimestamp(result[0][0], timezone.utc)
+            batch_end = datetime.fromtimestamp(result[-1][0], timezone.utc)
+            with time_stage("bucket_creation", table=table_name):
+                insert_new_buckets(
+                    conn,
+                    table_name,
+                    batch_start,
+                    batch_end + bucket_width,
+                    bucket_width,
+                    timedelta(minutes=table_specs["align_offset_minutes"]),
+                )
+            with time_stage("write", table=table_name):
+                update_data(conn, table_name, table_updates)
+            with time_stage("summaries", table=table_name):
+                update_rolling_summaries(conn, table_name, table_specs, table_updates)
+
+            # cells spooled again since they were read stay pending
+            with connection:
+                connection.executemany(
+                    "UPDATE cells SET pending = 0 WHERE table_name = ? "
+                    "AND start_time = ? AND column_name = ? AND sequence = ?",
+                    [
+                        (table_name, start_epoch, column, sequence)
+                        for start_epoch, column, _, sequence in result
+                    ],
+                )
+            if len(result) < batch_cells:
+                break
+
+    # written cells are only kept for change detection within the lookback
+    with connection:
+        connection.execute(
+            "DELETE FROM cells WHERE pending = 0 AND start_time < ?",
+            ((get_query_window()[0] - timedelta(days=1)).timestamp(),),
+        )
+    pending_cells = connection.execute(
+        "SELECT count(*) FROM cells WHERE pending = 1"
+    ).fetchone()[0]
+    connection.close()
+    record_run_metric("sandiego_spool_pending_cells", {}, pending_cells)
+
+
+def run_spool_writer(table_config):
+    # drains whenever a run appends, and retries on an interval while postgres
+    # is unreachable without losing anything already spooled
+    flush_seconds = int(os.environ.get("SANDIEGO_SPOOL_FLUSH_SECONDS", "30"))
+    conn = None
+    while True:
+        spool_state["wake"].wait(flush_seconds)
+        spool_state["wake"].clear()
+        try:
+            if conn is None or conn.closed:
+                conn = get_database_connection()
+            drain_spool(conn, table_config)
+        except Exception as e:
+            print(
+                "Spool writer failed, retrying in", flush_seconds, "seconds:", repr(e)
+            )
+            if conn is not None:
+                conn.close()
+            conn = None
+
+
+def start_spool_writer():
+    if os.environ.get("SANDIEGO_SPOOL", "false").lower() == "true":
+        _, table_config, _ = load_configuration()
+        threading.Thread(
+            target=run_spool_writer, args=(table_config,), daemon=True
+        ).start()
+        print(
+            "Spooling writes through",
+            get_account_path("SANDIEGO_SPOOL_FILE", "spool.sqlite3"),
+        )
+
+
+def load_configuration():
     with open("configuration.yml", "r") as file:
         configuration_data = yaml.safe_load(file)
     provider_config = configuration_data["providers"]
     table_config = configuration_data["tables"]
     metric_config = configuration_data["metrics"]
 
-    backfill_metric = os.environ.get("SANDIEGO_BACKFILL_METRIC")
-    if backfill_metric in metric_config.keys():
-        metric_config = {backfill_metric: metric_config[backfill_metric]}
+    # accounts can override provider settings and point metrics at their own
+    # home assistant entities
+    if active_account["name"] is not None:
+        account_specs = configuration_data["accounts"][active_account["name"]]
+        provider_config = {
+            provider_name: {
+                **provider_specs,
+                **account_specs.get("providers", {}).get(provider_name, {}),
+            }
+            for provider_name, provider_specs in provider_config.items()
+        }
+        hass_entities = account_specs.get("hass_entities", {})
+        metric_config = {
+            metric_name: {
+                **metric_specs,
+                **(
+                    {"hass_metric_id": hass_entities[metric_specs["hass_metric_id"]]}
+                    if metric_specs.get("hass_metric_id") in hass_entities
+                    else {}
+                ),
+            }
+            for metric_name, metric_specs in metric_config.items()
+        }
 
-    lookback_minutes = int(os.environ.get("SANDIEGO_LOOKBACK_MINUTES", 2 * 24 * 60))
-    lookback_duration = timedelta(minutes=lookback_minutes)
-    query_end = datetime.now(timezone.utc)
-    query_start = query_end - lookback_duration
+    # metrics from disabled providers are skipped entirely
+    metric_config = {
+        metric_name: metric_specs
+        for metric_name, metric_specs in metric_config.items()
+        if provider_config[metric_specs["provider"]]["enabled"]
+    }
+    return provider_config, table_config, metric_config
+
+
+def compile_metric_plan(table_config, metric_config):
+    # group each table's metrics by the source they scan, so every source is
+    # read once per table and produces all of its metrics together
+    metric_plan = {}
+    for table_name in table_config:
+        metric_groups = {}
+        for metric_name, metric_specs in metric_config.items():
+            if table_name not in metric_specs["tables"]:
+                continue
+            if metric_specs["provider"] == "homeassistant":
+                group_key = ("hass_state", metric_specs["hass_metric_id"])
+            elif metric_specs["aggregate"] in [
+                "fitbit_steps_sum",
+                "fitbit_heart_mean",
+                "fitbit_heart_percentile",
+            ]:
+                group_key = ("fitbit_intraday", metric_specs["fitbit_type"])
+            elif metric_specs["aggregate"] in ["fitbit_sleep", "fitbit_heart_rmssd"]:
+                group_key = (metric_specs["aggregate"], metric_specs["fitbit_type"])
+            else:
+                raise Exception("Aggregate method not supported.")
+            metric_groups.setdefault(group_key, {})[metric_name] = metric_specs
+        metric_plan[table_name] = metric_groups
+    return metric_plan
+
+
+def aggregate_metric_group(
+    group_key,
+    metrics,
+    rows,
+    bucket_starts,
+    bucket_ends,
+    data_homeassistant,
+    data_fitbit,
+    intraday_fitbit,
+    rollups,
+):
+    group_kind, source = group_key
+    group_values = {}
+
+    if group_kind == "fitbit_intraday":
+        # every percentile comes from a single sort or histogram merge
+        percentiles = get_fitbit_heart_percentiles(
+            bucket_starts,
+            bucket_ends,
+            intraday_fitbit[source],
+            sorted(
+                {
+                    metric_specs["fitbit_heart_percentile"]
+                    for metric_specs in metrics.values()
+                    if metric_specs["aggregate"] == "fitbit_heart_percentile"
+                }
+            ),
+            rollups.get(("histogram", source)),
+        )
+        for metric_name, metric_specs in metrics.items():
+            if metric_specs["aggregate"] == "fitbit_steps_sum":
+                group_values[metric_name] = get_fitbit_steps_sum(
+                    bucket_starts,
+                    bucket_ends,
+                    intraday_fitbit[source],
+                    rollups.get(("totals", source)),
+                )
+            elif metric_specs["aggregate"] == "fitbit_heart_mean":
+                group_values[metric_name] = get_fitbit_heart_mean(
+                    bucket_starts,
+                    bucket_ends,
+                    intraday_fitbit[source],
+                    rollups.get(("totals", source)),
+                )
+            else:
+                group_values[metric_name] = percentiles[
+                    metric_specs["fitbit_heart_percentile"]
+                ]
+
+    elif group_kind == "hass_state":
+        # one sweep of the entity's history serves every metric reading it
+        bucket_summaries = state_data_to_bucket_durations(
+            bucket_starts, bucket_ends, data_homeassistant[source], None
+        )
+        for metric_name, metric_specs in metrics.items():
+            if metric_specs["aggregate"] == "hass_state_to_select":
+                group_values[metric_name] = get_predominant_state(bucket_summaries)
+            elif metric_specs["aggregate"] == "hass_state_to_hours":
+                group_values[metric_name] = get_state_duration_hours(
+                    bucket_summaries, metric_specs["select_states"]
+                )
+            else:
+                group_values[metric_name] = get_state_sensor_analog(
+                    bucket_summaries, metric_specs["analog_aggregate_method"]
+                )
 
-    if provider_config["homeassistant"]["enabled"]:
-        data_homeassistant = get_data_hass(query_start, metric_config)
+    elif group_kind == "fitbit_sleep":
+        sleep_items = get_longest_sleep_items(data_fitbit[source])
+        group_values = {metric_name: [] for metric_name in metrics}
+        for row in rows:
+            sleep_item = sleep_items.get(row["start_time"].date().isoformat())
+            if sleep_item is None:
+                print(
+                    "Warning: No sleep entry found for date",
+                    row["start_time"].date().isoformat(),
+                )
+            for metric_name, metric_specs in metrics.items():
+                group_values[metric_name].append(
+                    None
+                    if sleep_item is None
+                    else get_fitbit_sleep(sleep_item, metric_specs["fitbit_sleep_item"])
+                )
 
-    if provider_config["fitbit"]["enabled"]:
-        data_fitbit = get_data_fitbit(
+    elif group_kind == "fitbit_heart_rmssd":
+        rmssd_values = [
+            get_fitbit_heart_rmssd(
+                row["start_time"], row["end_time"], data_fitbit[source]
+            )
+            for row in rows
+        ]
+        group_values = {metric_name: rmssd_values for metric_name in metrics}
+
+    return group_values
+
+
+def get_intraday_fitbit(metric_plan, data_fitbit):
+    # parse every intraday source once for all tables
+    return {
+        source: parse_fitbit_intraday(
+            data_fitbit[source], "activities-" + source + "-intraday"
+        )
+        for metric_groups in metric_plan.values()
+        for group_kind, source in metric_groups
+        if group_kind == "fitbit_intraday"
+    }
+
+
+def get_fitbit_rollups(
+    table_config, metric_plan, intraday_fitbit, query_start, query_end
+):
+    # rollup mode aggregates raw samples once into the finest grid and merges
+    # those partial aggregates into every table
+    if os.environ.get("SANDIEGO_ROLLUP", "false").lower() != "true":
+        return {}
+    return build_fitbit_rollups(
+        table_config, metric_plan, intraday_fitbit, query_start, query_end
+    )
+
+
+def load_table_data(
+    conn, table_name, table_specs, metric_groups, query_start, query_end
+):
+    table_columns = [
+        metric_name for metrics in metric_groups.values() for metric_name in metrics
+    ]
+    if conn is None:
+        # without a connection the spool holds the current data
+        return get_spool_table_data(
+            table_name, table_specs, query_start, query_end, table_columns
+        )
+
+    # insert new rows
+    with time_stage("bucket_creation", table=table_name):
+        insert_new_buckets(
+            conn,
+            table_name,
             query_start,
             query_end,
-            provider_config["fitbit"]["url_schemas"],
-            metric_config,
+            timedelta(minutes=table_specs["duration_minutes"]),
+            timedelta(minutes=table_specs["align_offset_minutes"]),
         )
 
-    for table_name in table_config:
-        # insert new rows
-        new_buckets = get_buckets(
+    # get current data
+    return get_table_data(conn, table_name, query_start, query_end, table_columns)
+
+
+def get_group_updates(
+    table_name,
+    group_key,
+    metrics,
+    table_data,
+    bucket_starts,
+    bucket_ends,
+    recompute_from,
+    query_start,
+    data_homeassistant,
+    data_fitbit,
+    intraday_fitbit,
+    rollups,
+):
+    # only recompute buckets that end at or after the given time, a fitbit
+    # sample at midnight belongs to the bucket ending at midnight
+    group_watermark = min(
+        [
+            recompute_from.get(table_name + "." + metric_name, query_start)
+            for metric_name in metrics
+        ]
+    )
+    first_row = int(
+        np.searchsorted(bucket_ends, group_watermark.timestamp(), side="left")
+    )
+    group_rows = table_data[first_row:]
+    with time_stage("aggregation", table=table_name, group=":".join(group_key)):
+        group_values = aggregate_metric_group(
+            group_key,
+            metrics,
+            group_rows,
+            bucket_starts[first_row:],
+            bucket_ends[first_row:],
+            data_homeassistant,
+            data_fitbit,
+            intraday_fitbit,
+            rollups,
+        )
+    # only write the cells whose value actually changed
+    return {
+        metric_name: {
+            row["start_time"]: value
+            for row, value in zip(group_rows, values)
+            if value_changed(row[metric_name], value)
+        }
+        for metric_name, values in group_values.items()
+    }
+
+
+def write_table_updates(conn, table_name, table_updates):
+    if conn is None:
+        with time_stage("spool", table=table_name):
+            append_spool(table_name, table_updates)
+    else:
+        with time_stage("write", table=table_name):
+            update_data(conn, table_name, table_updates)
+
+
+def update_tables(
+    conn,
+    table_config,
+    metric_plan,
+    query_start,
+    query_end,
+    data_homeassistant,
+    data_fitbit,
+    recompute_from=None,
+):
+    if recompute_from is None:
+        recompute_from = {}
+
+    intraday_fitbit = get_intraday_fitbit(metric_plan, data_fitbit)
+    rollups = get_fitbit_rollups(
+        table_config, metric_plan, intraday_fitbit, query_start, query_end
+    )
+
+    written_metrics = []
+    for table_name, metric_groups in metric_plan.items():
+        table_data = load_table_data(
+            conn,
+            table_name,
+            table_config[table_name],
+            metric_groups,
             query_start,
             query_end,
-            timedelta(minutes=table_config[table_name]["duration_minutes"]),
-            timedelta(minutes=table_config[table_name]["align_offset_minutes"]),
         )
-        insert_new_buckets(conn, table_name, new_buckets)
+        bucket_starts, bucket_ends = get_bucket_bounds(table_data)
+        table_updates = {}
+        for group_key, metrics in metric_groups.items():
+            table_updates.update(
+                get_group_updates(
+                    table_name,
+                    group_key,
+                    metrics,
+                    table_data,
+                    bucket_starts,
+                    bucket_ends,
+                    recompute_from,
+                    query_start,
+                    data_homeassistant,
+                    data_fitbit,
+                    intraday_fitbit,
+                    rollups,
+                )
+            )
 
-        # get relevant metrics
-        table_metrics = [
-            metric
-            for metric in metric_config
-            if table_name in metric_config[metric]["tables"]
-            and provider_config[metric_config[metric]["provider"]]["enabled"]
+        # write every changed cell of the table at once
+        write_table_updates(conn, table_name, table_updates)
+        if conn is not None:
+            with time_stage("summaries", table=table_name):
+                update_rolling_summaries(
+                    conn, table_name, table_config[table_name], table_updates
+                )
+        written_metrics += [
+            table_name + "." + metric_name for metric_name in table_updates
         ]
+    return written_metrics
 
-        # get current data
-        table_data = get_table_data(conn, table_name, query_start, query_end)
-
-        for metric_name in table_metrics:
-            metric_specs = metric_config[metric_name]
-            submit_data = {}
-            for row in table_data:
-                # aggregate methods
-                if metric_specs["aggregate"] == "fitbit_sleep":
-                    submit_data[row["id"]] = get_fitbit_sleep(
-                        row["start_time"],
-                        row["end_time"],
-                        data_fitbit[metric_specs["fitbit_type"]],
-                        metric_specs["fitbit_sleep_item"],
-                    )
-                elif metric_specs["aggregate"] == "fitbit_steps_sum":
-                    submit_data[row["id"]] = get_fitbit_steps_sum(
-                        row["start_time"],
-                        row["end_time"],
-                        data_fitbit[metric_specs["fitbit_type"]],
-                    )
-                elif metric_specs["aggregate"] == "fitbit_heart_mean":
-                    submit_data[row["id"]] = get_fitbit_heart_mean(
-                        row["start_time"],
-                        row["end_time"],
-                        data_fitbit[metric_specs["fitbit_type"]],
-                    )
-                elif metric_specs["aggregate"] == "fitbit_heart_percentile":
-                    submit_data[row["id"]] = get_fitbit_heart_percentile(
-                        row["start_time"],
-                        row["end_time"],
-                        data_fitbit[metric_specs["fitbit_type"]],
-                        metric_specs["fitbit_heart_percentile"],
-                    )
-                elif metric_specs["aggregate"] == "fitbit_heart_rmssd":
-                    submit_data[row["id"]] = get_fitbit_heart_rmssd(
-                        row["start_time"],
-                        row["end_time"],
-                        data_fitbit[metric_specs["fitbit_type"]],
-                    )
-                elif metric_specs["aggregate"] == "hass_state_to_select":
-                    submit_data[row["id"]] = get_predominant_state(
-                        row["start_time"],
-                        row["end_time"],
-                        data_homeassistant[metric_specs["hass_metric_id"]],
-                        table_data[-1][metric_name],
+
+def get_query_window():
+    lookback_minutes = int(os.environ.get("SANDIEGO_LOOKBACK_MINUTES", 2 * 24 * 60))
+    query_end = datetime.now(timezone.utc)
+    return query_end - timedelta(minutes=lookback_minutes), query_end
+
+
+def refresh_provider(
+    provider_name,
+    provider_specs,
+    metric_config,
+    retained,
+    provider_watermark,
+    query_start,
+    query_end,
+):
+    # fetch what is newer than the watermark and merge it into the retained
+    # history, returning the merged data and where each source changed
+    provider_data = {}
+    changed_from = {}
+    if provider_name == "homeassistant":
+        hass_metrics = {
+            metric["hass_metric_id"]
+            for metric in metric_config.values()
+            if metric["provider"] == "homeassistant"
+        }
+        fetch_start = provider_watermark or query_start
+        if fetch_start <= query_start or not hass_metrics <= retained.keys():
+            fetch_start = query_start
+            retained = {}
+        with time_stage("fetch", provider="homeassistant"):
+            data_fetched = get_data_hass(fetch_start, query_end, metric_config)
+        for hass_metric, history in data_fetched.items():
+            (
+                provider_data[hass_metric],
+                changed_from[("homeassistant", hass_metric)],
+            ) = merge_hass_history(
+                retained.get(hass_metric, (np.zeros(0), [])), history, query_start
+            )
+    else:
+        fitbit_types = {
+            metric["fitbit_type"]
+            for metric in metric_config.values()
+            if metric["provider"] == "fitbit"
+        }
+        # the day before the watermark may still be filling in, and is fetched
+        # whole since it replaces the retained day
+        fetch_start = (provider_watermark or query_start) - timedelta(days=1)
+        if fetch_start <= query_start or not fitbit_types <= retained.keys():
+            fetch_start = query_start
+            retained = {}
+        else:
+            fetch_start = max(
+                query_start,
+                fetch_start.replace(hour=0, minute=0, second=0, microsecond=0),
+            )
+        with time_stage("fetch", provider="fitbit"):
+            data_fetched = get_data_fitbit(
+                fetch_start,
+                query_end,
+                provider_specs["url_schemas"],
+                metric_config,
+            )
+        for fitbit_type, responses in data_fetched.items():
+            (
+                provider_data[fitbit_type],
+                changed_from[("fitbit", fitbit_type)],
+            ) = merge_fitbit_data(retained.get(fitbit_type, {}), responses, query_start)
+    return provider_data, changed_from
+
+
+def get_metric_source(metric_specs):
+    if metric_specs["provider"] == "homeassistant":
+        return ("homeassistant", metric_specs["hass_metric_id"])
+    return ("fitbit", metric_specs["fitbit_type"])
+
+
+def get_recompute_from(
+    metric_config, table_names, metric_watermarks, changed_from, query_start
+):
+    # only recompute buckets that end after the source data changed or after
+    # the metric was last computed
+    recompute_from = {}
+    for metric_name, metric_specs in metric_config.items():
+        source_changed_from = changed_from.get(get_metric_source(metric_specs))
+        for table_name in metric_specs["tables"]:
+            if table_name not in table_names:
+                continue
+            metric_key = table_name + "." + metric_name
+            recompute_from[metric_key] = metric_watermarks.get(metric_key, query_start)
+            if source_changed_from is not None:
+                recompute_from[metric_key] = min(
+                    recompute_from[metric_key], source_changed_from
+                )
+    return recompute_from
+
+
+def parse_utc_datetime(value):
+    # command line times without an offset are utc, never the container's zone
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def get_processing_windows(query_start, query_end, table_config, window_buckets):
+    # windows are whole buckets of the coarsest table so no bucket is split,
+    # plus the partial head and tail that only finer tables have buckets in
+    coarsest_table = max(
+        table_config.values(), key=lambda table: table["duration_minutes"]
+    )
+    bucket_width = timedelta(minutes=coarsest_table["duration_minutes"])
+    grid_start, bucket_count = get_bucket_grid(
+        query_start,
+        query_end,
+        bucket_width,
+        timedelta(minutes=coarsest_table["align_offset_minutes"]),
+    )
+    window_bounds = {query_start, query_end}
+    for i in range(0, bucket_count + 1, window_buckets):
+        window_bounds.add(grid_start + bucket_width * i)
+    window_bounds.add(grid_start + bucket_width * bucket_count)
+    window_bounds = sorted(
+        bound for bound in window_bounds if query_start <= bound <= query_end
+    )
+    return list(zip(window_bounds[:-1], window_bounds[1:]))
+
+
+def refresh_window(
+    conn,
+    provider_config,
+    table_config,
+    metric_config,
+    metric_plan,
+    state,
+    watermarks,
+    query_start,
+    query_end,
+):
+    provider_data = {"homeassistant": {}, "fitbit": {}}
+    changed_from = {}
+    for provider_name, provider_specs in provider_config.items():
+        if not provider_specs["enabled"]:
+            continue
+        provider_data[provider_name], provider_changed_from = refresh_provider(
+            provider_name,
+            provider_specs,
+            metric_config,
+            state.get(provider_name, {}),
+            watermarks["providers"].get(provider_name),
+            query_start,
+            query_end,
+        )
+        changed_from.update(provider_changed_from)
+
+    written_metrics = update_tables(
+        conn,
+        table_config,
+        metric_plan,
+        query_start,
+        query_end,
+        provider_data["homeassistant"],
+        provider_data["fitbit"],
+        get_recompute_from(
+            metric_config,
+            table_config,
+            watermarks["metrics"],
+            changed_from,
+            query_start,
+        ),
+    )
+    return provider_data, written_metrics
+
+
+def refresh_window_pipelined(
+    conn,
+    provider_config,
+    table_config,
+    metric_config,
+    metric_plan,
+    state,
+    watermarks,
+    query_start,
+    query_end,
+):
+    # providers fetch concurrently while the tables are read, every group of
+    # metrics aggregates in the pool as soon as its provider has landed, and a
+    # single writer drains finished groups while later ones still compute
+    provider_data = {"homeassistant": {}, "fitbit": {}}
+    fetch_executor = ThreadPoolExecutor(max_workers=len(provider_config))
+    fetches = {
+        fetch_executor.submit(
+            refresh_provider,
+            provider_name,
+            provider_specs,
+            metric_config,
+            state.get(provider_name, {}),
+            watermarks["providers"].get(provider_name),
+            query_start,
+            query_end,
+        ): provider_name
+        for provider_name, provider_specs in provider_config.items()
+        if provider_specs["enabled"]
+    }
+
+    table_data = {}
+    bucket_bounds = {}
+    for table_name, metric_groups in metric_plan.items():
+        table_data[table_name] = load_table_data(
+            conn,
+            table_name,
+            table_config[table_name],
+            metric_groups,
+            query_start,
+            query_end,
+        )
+        bucket_bounds[table_name] = get_bucket_bounds(table_data[table_name])
+
+    # the writer owns the connection from here on
+    table_updates = {table_name: {} for table_name in metric_plan}
+    write_executor = ThreadPoolExecutor(max_workers=1)
+    writes = []
+
+    def write_group(table_name, aggregation):
+        group_updates = aggregation.result()
+        if any(len(cells) for cells in group_updates.values()):
+            write_table_updates(conn, table_name, group_updates)
+        table_updates[table_name].update(group_updates)
+
+    with ThreadPoolExecutor(
+        max_workers=int(os.environ.get("SANDIEGO_PIPELINE_WORKERS", os.cpu_count()))
+    ) as aggregate_executor:
+        for fetch in as_completed(fetches):
+            provider_name = fetches[fetch]
+            provider_data[provider_name], changed_from = fetch.result()
+            recompute_from = get_recompute_from(
+                metric_config,
+                table_config,
+                watermarks["metrics"],
+                changed_from,
+                query_start,
+            )
+            intraday_fitbit = {}
+            rollups = {}
+            if provider_name == "fitbit":
+                intraday_fitbit = get_intraday_fitbit(
+                    metric_plan, provider_data["fitbit"]
+                )
+                rollups = get_fitbit_rollups(
+                    table_config, metric_plan, intraday_fitbit, query_start, query_end
+                )
+            for table_name, metric_groups in metric_plan.items():
+                for group_key, metrics in metric_groups.items():
+                    group_provider = (
+                        "homeassistant" if group_key[0] == "hass_state" else "fitbit"
                     )
-                elif metric_specs["aggregate"] == "hass_state_to_hours":
-                    submit_data[row["id"]] = get_state_duration_hours(
-                        row["start_time"],
-                        row["end_time"],
-                        data_homeassistant[metric_specs["hass_metric_id"]],
-                        table_data[-1][metric_name],
-                        metric_specs["select_states"],
+                    if group_provider != provider_name:
+                        continue
+                    aggregation = aggregate_executor.submit(
+                        get_group_updates,
+                        table_name,
+                        group_key,
+                        metrics,
+                        table_data[table_name],
+                        *bucket_bounds[table_name],
+                        recompute_from,
+                        query_start,
+                        provider_data["homeassistant"],
+                        provider_data["fitbit"],
+                        intraday_fitbit,
+                        rollups,
                     )
-                elif metric_specs["aggregate"] == "hass_state_sensor_analog":
-                    submit_data[row["id"]] = get_state_sensor_analog(
-                        row["start_time"],
-                        row["end_time"],
-                        data_homeassistant[metric_specs["hass_metric_id"]],
-                        table_data[-1][metric_name],
-                        metric_specs["analog_aggregate_method"],
+                    aggregation.add_done_callback(
+                        lambda aggregation, table_name=table_name: writes.append(
+                            write_executor.submit(write_group, table_name, aggregation)
+                        )
                     )
-            update_data(conn, table_name, metric_name, submit_data)
+    fetch_executor.shutdown()
+
+    # every aggregation has finished and queued its write by now
+    write_executor.shutdown()
+    for write in writes:
+        write.result()
+
+    written_metrics = []
+    for table_name, updates in table_updates.items():
+        if conn is not None:
+            with time_stage("summaries", table=table_name):
+                update_rolling_summaries(
+                    conn, table_name, table_config[table_name], updates
+                )
+        written_metrics += [table_name + "." + metric_name for metric_name in updates]
+    return provider_data, written_metrics
+
+
+def main(state=None):
+    print("Starting new run at", datetime.now().isoformat())
+    run_start = time.monotonic()
+
+    # with the spool enabled the run never touches postgres
+    conn = None
+    if os.environ.get("SANDIEGO_SPOOL", "false").lower() != "true":
+        conn = get_database_connection()
+
+    provider_config, table_config, metric_config = load_configuration()
+
+    backfill_metric = os.environ.get("SANDIEGO_BACKFILL_METRIC")
+    if backfill_metric in metric_config.keys():
+        metric_config = {backfill_metric: metric_config[backfill_metric]}
+    metric_plan = compile_metric_plan(table_config, metric_config)
+
+    query_start, query_end = get_query_window()
+
+    # streaming mode works through the lookback in windows of whole buckets of
+    # the coarsest table, so only one window of data is held at a time
+    streaming = os.environ.get("SANDIEGO_STREAMING", "false").lower() == "true"
+    if streaming:
+        windows = get_processing_windows(
+            query_start,
+            query_end,
+            table_config,
+            int(os.environ.get("SANDIEGO_WINDOW_BUCKETS", "7")),
+        )
+    else:
+        windows = [(query_start, query_end)]
+
+    # incremental mode only fetches and recomputes what changed since the
+    # watermarks, merging new data into the history retained in state
+    incremental = (
+        os.environ.get("SANDIEGO_INCREMENTAL", "false").lower() == "true"
+        and state is not None
+        and not backfill_metric
+        and not streaming
+    )
+    if incremental:
+        watermarks = load_watermarks()
+    else:
+        watermarks = {"providers": {}, "metrics": {}}
+        state = {}
+
+    # pipelined mode overlaps fetching, aggregation and writing within a window
+    refresh = refresh_window
+    if os.environ.get("SANDIEGO_PIPELINE", "false").lower() == "true":
+        refresh = refresh_window_pipelined
+
+    for window_start, window_end in windows:
+        if streaming:
+            print(
+                "Processing window",
+                window_start.isoformat(),
+                "to",
+                window_end.isoformat(),
+            )
+        provider_data, written_metrics = refresh(
+            conn,
+            provider_config,
+            table_config,
+            metric_config,
+            metric_plan,
+            state,
+            watermarks,
+            window_start,
+            window_end,
+        )
+
+    # only advance the watermarks once every table has been written, an
+    # incremental run is never streamed so it covers everything in one window
+    if incremental:
+        for metric_key in written_metrics:
+            watermarks["metrics"][metric_key] = query_end
+        for provider_name, provider_specs in provider_config.items():
+            if provider_specs["enabled"]:
+                state[provider_name] = provider_data[provider_name]
+                watermarks["providers"][provider_name] = query_end
+        save_watermarks(watermarks)
 
     # close the connection, clean up
-    conn.close()
+    if conn is not None:
+        conn.close()
+    record_run_metric(
+        "sandiego_stage_seconds", {"stage": "run"}, time.monotonic() - run_start
+    )
+    export_run_metrics()
     print("All tables updated at", datetime.now().isoformat())
     return
 
 
+# the scheduler keeps provider data, pending changes and connections warm
+# between jobs, every job runs on its own interval
+scheduler_state = {
+    "lock": threading.Lock(),
+    "data": {},
+    "pending_changes": {},
+    "watermarks": {"providers": {}, "metrics": {}},
+    "running": set(),
+    "connections": {},
+}
+
+
+def get_next_run(now, interval, align_offset):
+    # the first interval boundary after now, counted from midnight utc plus offset
+    grid_start = now.replace(hour=0, minute=0, second=0, microsecond=0) + align_offset
+    if grid_start > now:
+        grid_start -= timedelta(days=1)
+    return grid_start + interval * ((now - grid_start) // interval + 1)
+
+
+def run_provider_job(provider_name, provider_specs, metric_config):
+    query_start, query_end = get_query_window()
+    with scheduler_state["lock"]:
+        retained = scheduler_state["data"].get(provider_name, {})
+        provider_watermark = scheduler_state["watermarks"]["providers"].get(
+            provider_name
+        )
+    provider_data, changed_from = refresh_provider(
+        provider_name,
+        provider_specs,
+        metric_config,
+        retained,
+        provider_watermark,
+        query_start,
+        query_end,
+    )
+
+    # every table recomputes from the earliest change it has not seen yet
+    with scheduler_state["lock"]:
+        scheduler_state["data"][provider_name] = provider_data
+        scheduler_state["watermarks"]["providers"][provider_name] = query_end
+        for pending_changes in scheduler_state["pending_changes"].values():
+            for source, source_changed_from in changed_from.items():
+                if source_changed_from is not None:
+                    pending_changes[source] = min(
+                        pending_changes.get(source, source_changed_from),
+                        source_changed_from,
+                    )
+        save_watermarks(scheduler_state["watermarks"])
+
+
+def run_table_job(table_name, table_config, metric_config, metric_plan, provider_jobs):
+    table_providers = {
+        metric_specs["provider"]
+        for metrics in metric_plan[table_name].values()
+        for metric_specs in metrics.values()
+    }
+
+    # tables use the data already held, and only wait for a fetch in the same
+    # tick when its provider has never been fetched, newer data is picked up
+    # through the pending changes on the next run
+    with scheduler_state["lock"]:
+        unfetched = table_providers - scheduler_state["data"].keys()
+    wait(
+        [
+            provider_jobs[provider_name]
+            for provider_name in unfetched
+            if provider_name in provider_jobs
+        ]
+    )
+
+    query_start, query_end = get_query_window()
+    with scheduler_state["lock"]:
+        if not table_providers <= scheduler_state["data"].keys():
+            print("Skipping", table_name, "until its providers have been fetched")
+            return
+        data_homeassistant = scheduler_state["data"].get("homeassistant", {})
+        data_fitbit = scheduler_state["data"].get("fitbit", {})
+        changed_from = scheduler_state["pending_changes"][table_name]
+        scheduler_state["pending_changes"][table_name] = {}
+        recompute_from = get_recompute_from(
+            metric_config,
+            [table_name],
+            scheduler_state["watermarks"]["metrics"],
+            changed_from,
+            query_start,
+        )
+
+    conn = scheduler_state["connections"].get(table_name)
+    if os.environ.get("SANDIEGO_SPOOL", "false").lower() == "true":
+        conn = None
+    elif conn is None or conn.closed:
+        conn = get_database_connection()
+        scheduler_state["connections"][table_name] = conn
+    try:
+        written_metrics = update_tables(
+            conn,
+            table_config,
+            {table_name: metric_plan[table_name]},
+            query_start,
+            query_end,
+            data_homeassistant,
+            data_fitbit,
+            recompute_from,
+        )
+    except Exception:
+        # hand the changes back so the next run still recomputes them
+        if conn is not None:
+            conn.rollback()
+        with scheduler_state["lock"]:
+            pending_changes = scheduler_state["pending_changes"][table_name]
+            for source, source_changed_from in changed_from.items():
+                pending_changes[source] = min(
+                    pending_changes.get(source, source_changed_from),
+                    source_changed_from,
+                )
+        raise
+
+    with scheduler_state["lock"]:
+        for metric_key in written_metrics:
+            scheduler_state["watermarks"]["metrics"][metric_key] = query_end
+        save_watermarks(scheduler_state["watermarks"])
+
+
+def run_scheduled_job(job_key, job_function, *args):
+    job_start = time.monotonic()
+    try:
+        job_function(*args)
+    except Exception as e:
+        print("Job", ":".join(job_key), "failed:", repr(e))
+    finally:
+        record_run_metric(
+            "sandiego_stage_seconds",
+            {"stage": "job", "job": ":".join(job_key)},
+            time.monotonic() - job_start,
+        )
+        with scheduler_state["lock"]:
+            scheduler_state["running"].discard(job_key)
+
+
+def run_scheduler_tick(due_jobs, provider_config, table_config, metric_config):
+    # tables run alongside the fetches due at the same boundary, a fetch
+    # waiting on the fitbit rate limit never holds up the tables
+    metric_plan = compile_metric_plan(table_config, metric_config)
+    with ThreadPoolExecutor(max_workers=max(1, len(due_jobs))) as executor:
+        provider_jobs = {}
+        for job_kind, job_name in due_jobs:
+            if job_kind == "provider":
+                provider_jobs[job_name] = executor.submit(
+                    run_scheduled_job,
+                    (job_kind, job_name),
+                    run_provider_job,
+                    job_name,
+                    provider_config[job_name],
+                    metric_config,
+                )
+        for job_kind, job_name in due_jobs:
+            if job_kind == "table":
+                executor.submit(
+                    run_scheduled_job,
+                    (job_kind, job_name),
+                    run_table_job,
+                    job_name,
+                    table_config,
+                    metric_config,
+                    metric_plan,
+                    provider_jobs,
+                )
+    export_run_metrics()
+
+
+def run_scheduler():
+    provider_config, table_config, metric_config = load_configuration()
+    default_minutes = int(os.environ.get("SANDIEGO_SLEEP_MINUTES", "15"))
+    job_intervals = {}
+    for provider_name, provider_specs in provider_config.items():
+        if provider_specs["enabled"]:
+            job_intervals[("provider", provider_name)] = (
+                timedelta(
+                    minutes=provider_specs.get("refresh_minutes", default_minutes)
+                ),
+                timedelta(0),
+            )
+    for table_name, table_specs in table_config.items():
+        job_intervals[("table", table_name)] = (
+            timedelta(minutes=table_specs.get("refresh_minutes", default_minutes)),
+            timedelta(minutes=table_specs["align_offset_minutes"]),
+        )
+    scheduler_state["watermarks"] = load_watermarks()
+    scheduler_state["pending_changes"] = {table_name: {} for table_name in table_config}
+
+    # everything runs once at startup, then on its own aligned interval
+    next_runs = {job_key: datetime.now(timezone.utc) for job_key in job_intervals}
+    while True:
+        now = datetime.now(timezone.utc)
+        due_jobs = []
+        for job_key, next_run in next_runs.items():
+            if next_run > now:
+                continue
+            next_runs[job_key] = get_next_run(now, *job_intervals[job_key])
+            with scheduler_state["lock"]:
+                if job_key in scheduler_state["running"]:
+                    print("Skipping", ":".join(job_key), "while it is still running")
+                    continue
+                scheduler_state["running"].add(job_key)
+            due_jobs.append(job_key)
+        if len(due_jobs):
+            threading.Thread(
+                target=run_scheduler_tick,
+                args=(due_jobs, provider_config, table_config, metric_config),
+                daemon=True,
+            ).start()
+        sleep_seconds = (
+            min(next_runs.values()) - datetime.now(timezone.utc)
+        ).total_seconds()
+        time.sleep(max(0, sleep_seconds))
+
+
+def load_accounts():
+    with open("configuration.yml", "r") as file:
+        configuration_data = yaml.safe_load(file)
+    if not configuration_data.get("accounts"):
+        raise Exception("Workers need at least one account in the configuration.")
+    return configuration_data["accounts"]
+
+
+def use_account(account_name, account_specs, rate_limit):
+    # tokens and rate limits belong to the account, the stored rate limit
+    # carries over from whichever worker ran the account last
+    active_account["name"] = account_name
+    active_account["secrets_dir"] = account_specs.get(
+        "secrets_dir", os.path.join("./secrets", "accounts", account_name)
+    )
+    active_account["database_schema"] = account_specs.get(
+        "database_schema", account_name
+    )
+    with fitbit_auth["lock"]:
+        fitbit_auth["secrets"] = None
+    limit, remaining, reset_at = rate_limit
+    with fitbit_rate_limit["lock"]:
+        fitbit_rate_limit["limit"] = limit if limit is not None else 150
+        fitbit_rate_limit["remaining"] = (
+            remaining if remaining is not None else fitbit_rate_limit["limit"]
+        )
+        fitbit_rate_limit["reset_at"] = reset_at if reset_at is not None else 0.0
+
+
+def register_accounts(conn, accounts):
+    cursor = conn.cursor()
+    for account_name in accounts:
+        cursor.execute(
+            "INSERT INTO account_jobs (account_name, next_run_at) VALUES (%s, now()) "
+            "ON CONFLICT (account_name) DO NOTHING",
+            (account_name,),
+        )
+    conn.commit()
+    cursor.close()
+
+
+def claim_account(conn, worker_name, accounts):
+    # the first due account no other worker is claiming, skipping accounts
+    # that used up their fitbit rate limit until it resets
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT account_name, worker, fitbit_limit, fitbit_remaining, fitbit_reset_at "
+        "FROM account_jobs WHERE next_run_at <= now() AND account_name = ANY(%s) "
+        "AND (fitbit_remaining IS NULL OR fitbit_remaining > 0 "
+        "OR fitbit_reset_at <= extract(epoch FROM now())) "
+        "ORDER BY next_run_at LIMIT 1 FOR UPDATE SKIP LOCKED",
+        (list(accounts),),
+    )
+    claimed = cursor.fetchone()
+    if claimed is None:
+        conn.commit()
+        cursor.close()
+        return None
+    account_name = claimed[0]
+    refresh_minutes = accounts[account_name].get(
+        "refresh_minutes", int(os.environ.get("SANDIEGO_SLEEP_MINUTES", "15"))
+    )
+    cursor.execute(
+        "UPDATE account_jobs SET worker = %s, started_at = now(), next_run_at = now() + %s "
+        "WHERE account_name = %s",
+        (worker_name, timedelta(minutes=refresh_minutes), account_name),
+    )
+    # a run outlasting its interval keeps the lock, so it never runs twice at once
+    cursor.execute(
+        "SELECT pg_try_advisory_lock(hashtext(%s))", ("sandiego:" + account_name,)
+    )
+    locked = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    if not locked:
+        print("Skipping", account_name, "while another worker is still running it")
+        return None
+    return claimed
+
+
+def release_account(conn, account_name):
+    with fitbit_rate_limit["lock"]:
+        rate_limit = (
+            fitbit_rate_limit["limit"],
+            fitbit_rate_limit["remaining"],
+            fitbit_rate_limit["reset_at"],
+        )
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE account_jobs SET finished_at = now(), fitbit_limit = %s, "
+        "fitbit_remaining = %s, fitbit_reset_at = %s WHERE account_name = %s",
+        (*rate_limit, account_name),
+    )
+    cursor.execute(
+        "SELECT pg_advisory_unlock(hashtext(%s))", ("sandiego:" + account_name,)
+    )
+    conn.commit()
+    cursor.close()
+
+
+def run_account_worker():
+    worker_name = socket.gethostname() + ":" + str(os.getpid())
+    accounts = load_accounts()
+    poll_seconds = int(os.environ.get("SANDIEGO_WORKER_POLL_SECONDS", "30"))
+
+    # the coordination connection is opened before any account schema is active
+    conn = get_database_connection()
+    register_accounts(conn, accounts)
+    account_states = {}
+    while True:
+        claimed = claim_account(conn, worker_name, accounts)
+        if claimed is None:
+            time.sleep(poll_seconds)
+            continue
+        account_name, last_worker, *rate_limit = claimed
+
+        # retained data is only current if this worker ran the account last
+        if last_worker != worker_name:
+            account_states[account_name] = {}
+        print("Worker", worker_name, "running account", account_name)
+        use_account(account_name, accounts[account_name], rate_limit)
+        try:
+            main(account_states.setdefault(account_name, {}))
+        except Exception as e:
+            print("Run for account", account_name, "failed:", repr(e))
+        finally:
+            release_account(conn, account_name)
+
+
+def run_workers(worker_count):
+    # each process works on one account at a time, and containers running the
+    # same command share the accounts through the account_jobs table
+    if os.environ.get("SANDIEGO_SPOOL", "false").lower() == "true":
+        raise Exception("The spool cannot be used with account workers.")
+    if os.environ.get("SANDIEGO_METRICS_PORT") and worker_count > 1:
+        raise Exception(
+            "The metrics port cannot be used with more than one worker, "
+            "use the metrics file instead."
+        )
+    if worker_count == 1:
+        run_account_worker()
+    processes = [
+        multiprocessing.Process(target=run_account_worker) for _ in range(worker_count)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
 if __name__ == "__main__":
     print("App started.")
+    start_metrics_server()
+    if os.environ.get("SANDIEGO_WORKERS"):
+        run_workers(int(os.environ.get("SANDIEGO_WORKERS")))
+    start_spool_writer()
+    if os.environ.get("SANDIEGO_SCHEDULER", "false").lower() == "true":
+        run_scheduler()
+    state = {}
     while True:
-        main()
+        main(state)
         sleep_minutes = int(os.environ.get("SANDIEGO_SLEEP_MINUTES", "15"))
         time.sleep(sleep_minutes * 60)
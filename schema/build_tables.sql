@@ -70,4 +70,52 @@ CREATE TABLE intraday_1m (
     end_time TIMESTAMPTZ UNIQUE,
     steps_count_sum INTEGER,
     heart_rate_mean DECIMAL
-);
\ No newline at end of file
+);
+--
+CREATE TABLE IF NOT EXISTS backfill_windows (
+    metric_name VARCHAR,
+    window_start TIMESTAMPTZ,
+    window_end TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ,
+    PRIMARY KEY (metric_name, window_start, window_end)
+);
+--
+CREATE TABLE IF NOT EXISTS rolling_summaries (
+    source_table VARCHAR,
+    metric_name VARCHAR,
+    window_buckets INTEGER,
+    end_time TIMESTAMPTZ,
+    mean DOUBLE PRECISION,
+    pct_10 DOUBLE PRECISION,
+    pct_50 DOUBLE PRECISION,
+    pct_90 DOUBLE PRECISION,
+    sample_count INTEGER,
+    PRIMARY KEY (source_table, metric_name, window_buckets, end_time)
+);
+--
+CREATE TABLE IF NOT EXISTS rolling_correlations (
+    source_table VARCHAR,
+    metric_x VARCHAR,
+    metric_y VARCHAR,
+    window_buckets INTEGER,
+    end_time TIMESTAMPTZ,
+    sample_count INTEGER,
+    sum_x DOUBLE PRECISION,
+    sum_y DOUBLE PRECISION,
+    sum_xx DOUBLE PRECISION,
+    sum_yy DOUBLE PRECISION,
+    sum_xy DOUBLE PRECISION,
+    correlation DOUBLE PRECISION,
+    PRIMARY KEY (source_table, metric_x, metric_y, window_buckets, end_time)
+);
+--
+CREATE TABLE IF NOT EXISTS account_jobs (
+    account_name VARCHAR PRIMARY KEY,
+    next_run_at TIMESTAMPTZ,
+    worker VARCHAR,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    fitbit_limit INTEGER,
+    fitbit_remaining INTEGER,
+    fitbit_reset_at DOUBLE PRECISION
+);
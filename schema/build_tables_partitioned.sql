@@ -0,0 +1,27 @@
+DROP TABLE IF EXISTS intraday_15m;
+CREATE TABLE intraday_15m (
+    start_time TIMESTAMPTZ PRIMARY KEY,
+    end_time TIMESTAMPTZ NOT NULL,
+    steps_count_sum INTEGER,
+    heart_rate_mean REAL,
+    zone_select VARCHAR,
+    activity_select VARCHAR,
+    device_hours_phone REAL,
+    device_hours_desktop REAL,
+    device_hours_tv REAL,
+    climate_indoor_temperature_mean REAL,
+    climate_indoor_humidity_mean REAL,
+    climate_indoor_hvac_mode_select VARCHAR,
+    climate_outdoor_temperature_mean REAL,
+    climate_outdoor_humidity_mean REAL
+) PARTITION BY RANGE (start_time);
+CREATE INDEX intraday_15m_end_time_brin ON intraday_15m USING brin (end_time);
+--
+DROP TABLE IF EXISTS intraday_1m;
+CREATE TABLE intraday_1m (
+    start_time TIMESTAMPTZ PRIMARY KEY,
+    end_time TIMESTAMPTZ NOT NULL,
+    steps_count_sum SMALLINT,
+    heart_rate_mean REAL
+) PARTITION BY RANGE (start_time);
+CREATE INDEX intraday_1m_end_time_brin ON intraday_1m USING brin (end_time);
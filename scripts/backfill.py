@@ -0,0 +1,175 @@
+import argparse
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+
+def get_completed_windows(conn, query_start, query_end):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT metric_name, window_start, window_end FROM backfill_windows "
+        "WHERE window_start >= %s AND window_end <= %s",
+        (query_start, query_end),
+    )
+    result = cursor.fetchall()
+    cursor.close()
+    completed_windows = {}
+    for metric_name, window_start, window_end in result:
+        completed_windows.setdefault((window_start, window_end), set()).add(metric_name)
+    return completed_windows
+
+
+def record_completed_window(conn, metric_names, window_start, window_end):
+    cursor = conn.cursor()
+    for metric_name in metric_names:
+        cursor.execute(
+            "INSERT INTO backfill_windows "
+            "(metric_name, window_start, window_end, completed_at) "
+            "VALUES (%s, %s, %s, now()) "
+            "ON CONFLICT (metric_name, window_start, window_end) "
+            "DO UPDATE SET completed_at = now()",
+            (metric_name, window_start, window_end),
+        )
+    conn.commit()
+    cursor.close()
+
+
+def aggregate_window(
+    window_start, window_end, metric_names, data_homeassistant, data_fitbit
+):
+    # runs in a worker process with its own database connection
+    _, table_config, metric_config = app.load_configuration()
+    metric_config = {
+        metric_name: metric_config[metric_name] for metric_name in metric_names
+    }
+    metric_plan = app.compile_metric_plan(table_config, metric_config)
+    conn = app.get_database_connection()
+    app.update_tables(
+        conn,
+        table_config,
+        metric_plan,
+        window_start,
+        window_end,
+        data_homeassistant,
+        data_fitbit,
+    )
+    record_completed_window(conn, metric_names, window_start, window_end)
+    conn.close()
+    return window_start, window_end
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Backfill metrics window by window, resuming where the last run stopped."
+    )
+    parser.add_argument(
+        "--start",
+        required=True,
+        help="ISO date or time to start from, UTC unless an offset is given",
+    )
+    parser.add_argument(
+        "--end",
+        help="ISO date or time to stop at, UTC unless an offset is given, defaults to now",
+    )
+    parser.add_argument(
+        "--metric",
+        action="append",
+        help="metric to backfill, may be repeated, defaults to every metric",
+    )
+    parser.add_argument(
+        "--window-buckets",
+        type=int,
+        default=7,
+        help="number of buckets of the coarsest table per window",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="aggregation processes"
+    )
+    args = parser.parse_args()
+
+    query_start = app.parse_utc_datetime(args.start)
+    query_end = datetime.now(timezone.utc)
+    if args.end:
+        query_end = app.parse_utc_datetime(args.end)
+
+    provider_config, table_config, metric_config = app.load_configuration()
+    if args.metric:
+        for metric_name in args.metric:
+            if metric_name not in metric_config:
+                raise Exception("Metric " + metric_name + " is not configured.")
+        metric_config = {
+            metric_name: metric_config[metric_name] for metric_name in args.metric
+        }
+
+    conn = app.get_database_connection()
+    completed_windows = get_completed_windows(conn, query_start, query_end)
+    conn.close()
+
+    windows = app.get_processing_windows(
+        query_start, query_end, table_config, args.window_buckets
+    )
+    print("Backfilling", len(metric_config), "metrics over", len(windows), "windows")
+
+    # downloads stay in this process so the fitbit rate limit is shared, while
+    # finished downloads are aggregated and written by the process pool
+    pending = set()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for window_start, window_end in windows:
+            metric_names = sorted(
+                set(metric_config)
+                - completed_windows.get((window_start, window_end), set())
+            )
+            if not len(metric_names):
+                continue
+            print(
+                "Fetching window",
+                window_start.isoformat(),
+                "to",
+                window_end.isoformat(),
+            )
+            window_metrics = {
+                metric_name: metric_config[metric_name] for metric_name in metric_names
+            }
+            data_homeassistant = {}
+            if provider_config["homeassistant"]["enabled"]:
+                data_homeassistant = app.get_data_hass(
+                    window_start, window_end, window_metrics
+                )
+            data_fitbit = {}
+            if provider_config["fitbit"]["enabled"]:
+                data_fitbit = app.get_data_fitbit(
+                    window_start,
+                    window_end,
+                    provider_config["fitbit"]["url_schemas"],
+                    window_metrics,
+                )
+            pending.add(
+                executor.submit(
+                    aggregate_window,
+                    window_start,
+                    window_end,
+                    metric_names,
+                    data_homeassistant,
+                    data_fitbit,
+                )
+            )
+
+            # keep at most one queued window per worker in memory
+            while len(pending) >= args.workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    completed_start, _ = future.result()
+                    print("Completed window", completed_start.isoformat())
+
+        for future in pending:
+            completed_start, _ = future.result()
+            print("Completed window", completed_start.isoformat())
+    print("Backfill complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+# prometheus refuses ranges resolving to more points than this
+PROMETHEUS_MAX_POINTS = 11000
+PROMETHEUS_SLEEP_ITEMS = ["hours_inbed", "time_start", "time_end"]
+
+
+def get_query_chunks(range_start, range_end, step, max_points):
+    # consecutive chunks on the same step grid, never sharing a sample
+    chunk_width = step * (max_points - 1)
+    chunks = []
+    chunk_start = range_start
+    while chunk_start <= range_end:
+        chunks.append((chunk_start, min(chunk_start + chunk_width, range_end)))
+        chunk_start += chunk_width + step
+    return chunks
+
+
+def query_range(prometheus_url, query, chunk_start, chunk_end, step):
+    response = app.get_http_session("prometheus").get(
+        prometheus_url + "/api/v1/query_range",
+        params={
+            "query": query,
+            "start": chunk_start,
+            "end": chunk_end,
+            "step": step,
+        },
+    )
+    response_json = response.json()
+    if response_json["status"] != "success":
+        raise Exception("Prometheus query failed.", response_json.get("error"))
+
+    # every series of the chunk flattened into arrays
+    values = [
+        value
+        for series in response_json["data"]["result"]
+        for value in series["values"]
+    ]
+    if not len(values):
+        return np.zeros(0), np.zeros(0)
+    samples = np.array(values, dtype=np.float64)
+    return samples[:, 0], samples[:, 1]
+
+
+def get_history(
+    prometheus_url, query, range_start, range_end, step, max_points, workers
+):
+    chunks = get_query_chunks(range_start, range_end, step, max_points)
+    print("Querying", len(chunks), "chunks from Prometheus")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda chunk: query_range(prometheus_url, query, *chunk, step), chunks
+            )
+        )
+    epochs = np.concatenate([result[0] for result in results])
+    values = np.concatenate([result[1] for result in results])
+    order = np.argsort(epochs, kind="stable")
+    return epochs[order], values[order]
+
+
+def get_sleep_sessions(epochs, values):
+    # a session runs from a sample going to 1 until the next sample going to 0
+    if not np.isin(values, [0, 1]).all():
+        raise Exception("Sleep sensor has states other than 0 and 1.")
+    asleep = values == 1
+    previous = np.concatenate(([False], asleep[:-1]))
+    session_starts = epochs[asleep & ~previous]
+    session_ends = epochs[~asleep & previous]
+    # a session still running at the end of the range is not finished yet
+    return session_starts[: len(session_ends)], session_ends
+
+
+def get_sleep_buckets(epochs, values, table_specs, sleep_columns):
+    # each bucket keeps its longest session, assigned to the bucket it ends in
+    session_starts, session_ends = get_sleep_sessions(epochs, values)
+    if not len(session_ends):
+        return {}
+    bucket_starts = app.get_bucket_start(session_ends, table_specs)
+    order = np.lexsort((session_ends - session_starts, bucket_starts))
+    last_in_bucket = np.append(
+        bucket_starts[order][1:] != bucket_starts[order][:-1], True
+    )
+    longest = order[last_in_bucket]
+
+    buckets = {}
+    for bucket_start, session_start, session_end in zip(
+        bucket_starts[longest].tolist(),
+        session_starts[longest].tolist(),
+        session_ends[longest].tolist(),
+    ):
+        sleep_values = {
+            "hours_inbed": (session_end - session_start) / 3600,
+            "time_start": datetime.fromtimestamp(
+                session_start, timezone.utc
+            ).isoformat(),
+            "time_end": datetime.fromtimestamp(session_end, timezone.utc).isoformat(),
+        }
+        buckets[bucket_start] = {
+            metric_name: sleep_values[sleep_item]
+            for metric_name, sleep_item in sleep_columns.items()
+        }
+    return buckets
+
+
+def get_mean_buckets(epochs, values, table_specs, metric_name):
+    # samples are evenly spaced, so the bucket mean is the mean of its samples
+    valid = ~np.isnan(values)
+    bucket_starts, bucket_index = np.unique(
+        app.get_bucket_start(epochs[valid], table_specs), return_inverse=True
+    )
+    sums = np.bincount(bucket_index, weights=values[valid])
+    counts = np.bincount(bucket_index)
+    return {
+        bucket_start: {metric_name: mean}
+        for bucket_start, mean in zip(bucket_starts.tolist(), (sums / counts).tolist())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Backfill metrics from Prometheus history in parallel chunks."
+    )
+    parser.add_argument(
+        "--url",
+        default=os.environ.get("PROMETHEUS_URL", "http://prometheus:9090"),
+        help="Prometheus base url, defaults to $PROMETHEUS_URL or http://prometheus:9090",
+    )
+    parser.add_argument("--query", required=True, help="PromQL expression to fetch")
+    parser.add_argument(
+        "--mode",
+        choices=["sleep", "mean"],
+        required=True,
+        help="sleep detects sessions of a 0/1 sensor, mean averages into buckets",
+    )
+    parser.add_argument(
+        "--metric", help="configured metric to fill, required in mean mode"
+    )
+    parser.add_argument(
+        "--start",
+        required=True,
+        help="ISO date or time to start from, UTC unless an offset is given",
+    )
+    parser.add_argument(
+        "--end",
+        help="ISO date or time to stop at, UTC unless an offset is given, defaults to now",
+    )
+    parser.add_argument("--step", type=int, default=300, help="query step in seconds")
+    parser.add_argument(
+        "--max-points",
+        type=int,
+        default=PROMETHEUS_MAX_POINTS,
+        help="most points requested per query",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="concurrent queries")
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace existing values instead of only filling empty ones",
+    )
+    args = parser.parse_args()
+
+    query_start = app.parse_utc_datetime(args.start)
+    query_end = datetime.now(timezone.utc)
+    if args.end:
+        query_end = app.parse_utc_datetime(args.end)
+
+    _, table_config, metric_config = app.load_configuration()
+    if args.mode == "mean" and args.metric not in metric_config:
+        raise Exception("Mean mode needs a configured --metric.")
+
+    epochs, values = get_history(
+        args.url,
+        args.query,
+        int(query_start.timestamp()),
+        int(query_end.timestamp()),
+        args.step,
+        args.max_points,
+        args.workers,
+    )
+    print("Fetched", len(epochs), "samples")
+
+    conn = app.get_database_connection()
+    for table_name, table_specs in table_config.items():
+        if 1440 % table_specs["duration_minutes"]:
+            continue
+        if args.mode == "mean":
+            if table_name not in metric_config[args.metric]["tables"]:
+                continue
+            columns = [args.metric]
+            buckets = get_mean_buckets(epochs, values, table_specs, args.metric)
+        else:
+            sleep_columns = {
+                metric_name: metric_specs["fitbit_sleep_item"]
+                for metric_name, metric_specs in metric_config.items()
+                if table_name in metric_specs["tables"]
+                and metric_specs["aggregate"] == "fitbit_sleep"
+                and metric_specs["fitbit_sleep_item"] in PROMETHEUS_SLEEP_ITEMS
+            }
+            if not len(sleep_columns):
+                continue
+            columns = list(sleep_columns)
+            buckets = get_sleep_buckets(epochs, values, table_specs, sleep_columns)
+        app.copy_bucket_data(
+            conn, table_name, table_specs, columns, buckets, args.overwrite
+        )
+    conn.close()
+    print("Backfill complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+
+def generate_fitbit_intraday(query_dates, fitbit_type, rng):
+    # one sample per minute with a few gaps, as the 1min detail level returns
+    data = {}
+    for query_date in query_dates:
+        dataset = []
+        for minute in range(1440):
+            if rng.random() < 0.05:
+                continue
+            if fitbit_type == "steps":
+                value = rng.choice([0, 0, 0, rng.randint(1, 130)])
+            else:
+                value = rng.randint(50, 160)
+            dataset.append(
+                {"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": value}
+            )
+        data[query_date] = {
+            "activities-" + fitbit_type + "-intraday": {"dataset": dataset}
+        }
+    return data
+
+
+def generate_fitbit_sleep(query_dates, rng):
+    data = {}
+    for query_date in query_dates:
+        sleep_items = []
+        # a main sleep and sometimes a nap
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            minutes_asleep = rng.randint(20, 540)
+            sleep_items.append(
+                {
+                    "startTime": query_date + "T00:30:00.000",
+                    "endTime": query_date + "T08:00:00.000",
+                    "minutesAsleep": minutes_asleep,
+                    "timeInBed": minutes_asleep + rng.randint(0, 60),
+                    "levels": {
+                        "summary": {
+                            level: {"minutes": rng.randint(0, minutes_asleep // 3)}
+                            for level in ["deep", "light", "rem", "wake"]
+                        }
+                    },
+                }
+            )
+        data[query_date] = {"sleep": sleep_items}
+    return data
+
+
+def generate_fitbit_hrv(query_dates, rng):
+    return {
+        query_date: {"hrv": [{"value": {"dailyRmssd": rng.uniform(20, 80)}}]}
+        for query_date in query_dates
+    }
+
+
+def generate_hass_history(query_start, query_end, states, change_minutes, rng):
+    # state changes arrive as a poisson process with the given mean interval
+    epochs = []
+    history_states = []
+    epoch = query_start.timestamp()
+    while epoch < query_end.timestamp():
+        epochs.append(epoch)
+        history_states.append(rng.choice(states))
+        epoch += rng.expovariate(1 / (change_minutes * 60))
+    return np.array(epochs, dtype=np.float64), history_states
+
+
+def time_call(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def get_db_benchmarks(conn, table_name, table_specs, query_start, query_end, rng):
+    # scratch copy of the table so nothing real is touched
+    scratch_table = "benchmark_" + table_name
+    cursor = conn.cursor()
+    cursor.execute(
+        f"CREATE TEMP TABLE {scratch_table} (LIKE {table_name} INCLUDING ALL)"
+    )
+    conn.commit()
+    cursor.close()
+
+    bucket_width = timedelta(minutes=table_specs["duration_minutes"])
+    align_offset = timedelta(minutes=table_specs["align_offset_minutes"])
+    benchmarks = {}
+    start = time.perf_counter()
+    app.insert_new_buckets(
+        conn, scratch_table, query_start, query_end, bucket_width, align_offset
+    )
+    benchmarks["insert_new_buckets"] = [time.perf_counter() - start]
+    benchmarks["insert_new_buckets_existing"] = time_call(
+        lambda: app.insert_new_buckets(
+            conn, scratch_table, query_start, query_end, bucket_width, align_offset
+        ),
+        1,
+    )
+
+    table_data = app.get_table_data(conn, scratch_table, query_start, query_end)
+    column_types = app.get_column_types(conn, scratch_table)
+    columns = [
+        column
+        for column, data_type in column_types.items()
+        if data_type in ["smallint", "integer", "numeric", "double precision", "real"]
+        and column != "id"
+    ]
+    data = {
+        column: {row["start_time"]: rng.uniform(0, 100) for row in table_data}
+        for column in columns
+    }
+    start = time.perf_counter()
+    app.update_data(conn, scratch_table, data)
+    benchmarks["update_data"] = [time.perf_counter() - start]
+
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE {scratch_table}")
+    conn.commit()
+    cursor.close()
+    return benchmarks, len(table_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the aggregation functions against synthetic payloads."
+    )
+    parser.add_argument("--days", type=int, default=7, help="lookback to generate")
+    parser.add_argument(
+        "--change-minutes",
+        type=float,
+        default=10,
+        help="mean minutes between home assistant state changes",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="payload random seed")
+    parser.add_argument(
+        "--db",
+        action="store_true",
+        help="also time bucket inserts and updates against the configured postgres",
+    )
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument(
+        "--baseline", help="json results of an earlier run to compare against"
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    query_end = datetime.now(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    query_start = query_end - timedelta(days=args.days)
+    query_dates = app.dates_to_query_fitbit(query_start, query_end)
+
+    # generate every payload up front so only the aggregation is timed
+    data_fitbit = {
+        "steps": generate_fitbit_intraday(query_dates, "steps", rng),
+        "heart": generate_fitbit_intraday(query_dates, "heart", rng),
+        "sleep": generate_fitbit_sleep(query_dates, rng),
+        "hrv": generate_fitbit_hrv(query_dates, rng),
+    }
+    data_homeassistant = {
+        "zone": generate_hass_history(
+            query_start, query_end, ["home", "Work", "away"], args.change_minutes, rng
+        ),
+        "temperature": generate_hass_history(
+            query_start,
+            query_end,
+            [str(x / 2) for x in range(30, 50)] + ["unavailable"],
+            args.change_minutes,
+            rng,
+        ),
+    }
+    _, table_config, _ = app.load_configuration()
+
+    results = []
+
+    def record(name, table_name, bucket_count, timings):
+        results.append(
+            {
+                "name": name,
+                "table": table_name,
+                "buckets": bucket_count,
+                "min_seconds": min(timings),
+                "median_seconds": statistics.median(timings),
+            }
+        )
+        print(
+            f"{name:<32} {table_name or '':<16} {bucket_count:>8} "
+            f"{min(timings) * 1000:>10.2f} ms"
+        )
+
+    print(f"{'benchmark':<32} {'table':<16} {'buckets':>8} {'min':>13}")
+    for fitbit_type in ["steps", "heart"]:
+        timings = time_call(
+            lambda: app.parse_fitbit_intraday(
+                data_fitbit[fitbit_type], "activities-" + fitbit_type + "-intraday"
+            ),
+            args.repeat,
+        )
+        record("parse_fitbit_intraday_" + fitbit_type, None, 0, timings)
+    intraday_steps = app.parse_fitbit_intraday(
+        data_fitbit["steps"], "activities-steps-intraday"
+    )
+    intraday_heart = app.parse_fitbit_intraday(
+        data_fitbit["heart"], "activities-heart-intraday"
+    )
+
+    for table_name, table_specs in table_config.items():
+        bucket_width = timedelta(minutes=table_specs["duration_minutes"])
+        align_offset = timedelta(minutes=table_specs["align_offset_minutes"])
+        timings = time_call(
+            lambda: app.get_buckets(query_start, query_end, bucket_width, align_offset),
+            args.repeat,
+        )
+        buckets = app.get_buckets(query_start, query_end, bucket_width, align_offset)
+        bucket_count = len(buckets)
+        record("get_buckets", table_name, bucket_count, timings)
+        starts, ends = app.get_bucket_bounds(buckets)
+
+        benchmarks = {
+            "get_fitbit_steps_sum": lambda: app.get_fitbit_steps_sum(
+                starts, ends, intraday_steps
+            ),
+            "get_fitbit_heart_mean": lambda: app.get_fitbit_heart_mean(
+                starts, ends, intraday_heart
+            ),
+            "get_fitbit_heart_percentiles": lambda: app.get_fitbit_heart_percentiles(
+                starts, ends, intraday_heart, [10, 20, 50, 80, 90]
+            ),
+            "get_fitbit_heart_rmssd": lambda: [
+                app.get_fitbit_heart_rmssd(
+                    bucket["start_time"], bucket["end_time"], data_fitbit["hrv"]
+                )
+                for bucket in buckets
+            ],
+            "get_fitbit_sleep": lambda: [
+                app.get_fitbit_sleep(sleep_item, "hours_asleep")
+                for sleep_item in app.get_longest_sleep_items(
+                    data_fitbit["sleep"]
+                ).values()
+            ],
+            "state_data_to_bucket_durations": lambda: app.state_data_to_bucket_durations(
+                starts, ends, data_homeassistant["zone"], None
+            ),
+        }
+        zone_summaries = app.state_data_to_bucket_durations(
+            starts, ends, data_homeassistant["zone"], None
+        )
+        temperature_summaries = app.state_data_to_bucket_durations(
+            starts, ends, data_homeassistant["temperature"], None
+        )
+        benchmarks["get_predominant_state"] = lambda: app.get_predominant_state(
+            zone_summaries
+        )
+        benchmarks["get_state_duration_hours"] = lambda: app.get_state_duration_hours(
+            zone_summaries, ["home"]
+        )
+        benchmarks["get_state_sensor_analog"] = lambda: app.get_state_sensor_analog(
+            temperature_summaries, "mean"
+        )
+        for name, function in benchmarks.items():
+            record(name, table_name, bucket_count, time_call(function, args.repeat))
+
+    if args.db:
+        conn = app.get_database_connection()
+        for table_name, table_specs in table_config.items():
+            db_benchmarks, row_count = get_db_benchmarks(
+                conn, table_name, table_specs, query_start, query_end, rng
+            )
+            for name, timings in db_benchmarks.items():
+                record(name, table_name, row_count, timings)
+        conn.close()
+
+    output = {
+        "parameters": {
+            "days": args.days,
+            "change_minutes": args.change_minutes,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "hass_changes": sum(
+                len(epochs) for epochs, _ in data_homeassistant.values()
+            ),
+            "fitbit_samples": len(intraday_steps[0]) + len(intraday_heart[0]),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = {
+                (result["name"], result["table"]): result
+                for result in json.load(file)["results"]
+            }
+        print(f"\n{'benchmark':<32} {'table':<16} {'change':>10}")
+        for result in results:
+            previous = baseline.get((result["name"], result["table"]))
+            if previous is None or not previous["min_seconds"]:
+                continue
+            change = result["min_seconds"] / previous["min_seconds"] - 1
+            print(f"{result['name']:<32} {result['table'] or '':<16} {change:>+10.1%}")
+
+
+if __name__ == "__main__":
+    main()
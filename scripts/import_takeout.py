@@ -0,0 +1,225 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+# takeout values that can fill configured metrics
+TAKEOUT_SLEEP_ITEMS = ["hours_inbed", "time_start", "time_end"]
+
+
+def parse_activity_file(path):
+    # one row per interval, times are local with their utc offset
+    file_date = os.path.basename(path)[: -len(".csv")]
+    samples = []
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            start_time = datetime.fromisoformat(file_date + "T" + row["Start time"])
+            end_time = datetime.fromisoformat(file_date + "T" + row["End time"])
+            # the last interval of the day ends at the next midnight
+            if end_time <= start_time:
+                end_time += timedelta(days=1)
+            samples.append(
+                (
+                    start_time.timestamp(),
+                    end_time.timestamp(),
+                    int(row["Step count"] or 0),
+                )
+            )
+    return samples
+
+
+def parse_sleep_file(path):
+    with open(path, "r") as file:
+        session = json.load(file)
+    return (
+        datetime.fromisoformat(session["startTime"]).timestamp(),
+        datetime.fromisoformat(session["endTime"]).timestamp(),
+    )
+
+
+def get_import_columns(table_config, metric_config):
+    # the configured metrics takeout data can fill, per table
+    import_columns = {}
+    for table_name, table_specs in table_config.items():
+        if 1440 % table_specs["duration_minutes"]:
+            print("Skipping", table_name, "since its buckets do not divide a day")
+            continue
+        columns = {"steps": [], "sleep": {}}
+        for metric_name, metric_specs in metric_config.items():
+            if table_name not in metric_specs["tables"]:
+                continue
+            if metric_specs["aggregate"] == "fitbit_steps_sum":
+                columns["steps"].append(metric_name)
+            elif (
+                metric_specs["aggregate"] == "fitbit_sleep"
+                and metric_specs["fitbit_sleep_item"] in TAKEOUT_SLEEP_ITEMS
+            ):
+                columns["sleep"][metric_name] = metric_specs["fitbit_sleep_item"]
+        if len(columns["steps"]) or len(columns["sleep"]):
+            import_columns[table_name] = columns
+    return import_columns
+
+
+def import_steps(conn, executor, paths, table_config, import_columns, args):
+    # files are parsed in parallel but consumed in date order, so a bucket is
+    # complete once a later file starts after it ends
+    open_buckets = {table_name: {} for table_name in import_columns}
+    for samples in executor.map(parse_activity_file, paths, chunksize=16):
+        if not len(samples):
+            continue
+        for table_name, columns in import_columns.items():
+            if not len(columns["steps"]):
+                continue
+            table_specs = table_config[table_name]
+            buckets = open_buckets[table_name]
+            for sample_start, sample_end, steps in samples:
+                bucket_start = app.get_bucket_start(sample_start, table_specs)
+                # intervals that straddle buckets cannot be split exactly
+                if app.get_bucket_start(sample_end - 1, table_specs) != bucket_start:
+                    continue
+                buckets[bucket_start] = buckets.get(bucket_start, 0) + steps
+
+            width = table_specs["duration_minutes"] * 60
+            file_start = min(sample[0] for sample in samples)
+            complete = [b for b in buckets if b + width <= file_start]
+            if len(complete) >= args.batch_buckets:
+                app.copy_bucket_data(
+                    conn,
+                    table_name,
+                    table_specs,
+                    columns["steps"],
+                    {
+                        b: dict.fromkeys(columns["steps"], buckets.pop(b))
+                        for b in complete
+                    },
+                    args.overwrite,
+                )
+
+    for table_name, buckets in open_buckets.items():
+        columns = import_columns[table_name]["steps"]
+        app.copy_bucket_data(
+            conn,
+            table_name,
+            table_config[table_name],
+            columns,
+            {b: dict.fromkeys(columns, steps) for b, steps in buckets.items()},
+            args.overwrite,
+        )
+
+
+def import_sleep(conn, executor, paths, table_config, import_columns, args):
+    # like the fitbit sleep metrics, each bucket keeps its longest session,
+    # assigned to the bucket where the session ends
+    for table_name, columns in import_columns.items():
+        if not len(columns["sleep"]):
+            continue
+        table_specs = table_config[table_name]
+        longest_sessions = {}
+        for session_start, session_end in executor.map(
+            parse_sleep_file, paths, chunksize=16
+        ):
+            bucket_start = app.get_bucket_start(session_end, table_specs)
+            longest = longest_sessions.get(bucket_start)
+            if longest is None or session_end - session_start > longest[1] - longest[0]:
+                longest_sessions[bucket_start] = (session_start, session_end)
+
+        buckets = {}
+        for bucket_start, (session_start, session_end) in longest_sessions.items():
+            sleep_values = {
+                "hours_inbed": (session_end - session_start) / 3600,
+                "time_start": datetime.fromtimestamp(
+                    session_start, timezone.utc
+                ).isoformat(),
+                "time_end": datetime.fromtimestamp(
+                    session_end, timezone.utc
+                ).isoformat(),
+            }
+            buckets[bucket_start] = {
+                metric_name: sleep_values[sleep_item]
+                for metric_name, sleep_item in columns["sleep"].items()
+            }
+        app.copy_bucket_data(
+            conn,
+            table_name,
+            table_specs,
+            list(columns["sleep"]),
+            buckets,
+            args.overwrite,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import Google Fit steps and sleep from a Takeout export."
+    )
+    parser.add_argument(
+        "--takeout-dir",
+        default="./data/Takeout/Fit",
+        help="the Fit folder of the export, defaults to ./data/Takeout/Fit",
+    )
+    parser.add_argument("--start", help="first ISO date to import")
+    parser.add_argument("--end", help="last ISO date to import")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="parsing processes"
+    )
+    parser.add_argument(
+        "--batch-buckets",
+        type=int,
+        default=10000,
+        help="completed buckets to collect before each COPY",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace existing values instead of only filling empty ones",
+    )
+    args = parser.parse_args()
+
+    _, table_config, metric_config = app.load_configuration()
+    import_columns = get_import_columns(table_config, metric_config)
+
+    # daily files are named by date, so sorting them puts them in date order
+    activity_paths = sorted(
+        glob.glob(os.path.join(args.takeout_dir, "Daily activity metrics", "*.csv"))
+    )
+    activity_paths = [
+        path
+        for path in activity_paths
+        if os.path.basename(path)[:10] >= (args.start or "")
+        and os.path.basename(path)[:10] <= (args.end or "9999")
+        and len(os.path.basename(path)) == len("YYYY-MM-DD.csv")
+    ]
+    sleep_paths = sorted(
+        glob.glob(os.path.join(args.takeout_dir, "All Sessions", "*SLEEP.json"))
+    )
+    sleep_paths = [
+        path
+        for path in sleep_paths
+        if os.path.basename(path)[:10] >= (args.start or "")
+        and os.path.basename(path)[:10] <= (args.end or "9999")
+    ]
+    print(
+        "Importing",
+        len(activity_paths),
+        "activity files and",
+        len(sleep_paths),
+        "sleep sessions",
+    )
+
+    conn = app.get_database_connection()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        import_steps(conn, executor, activity_paths, table_config, import_columns, args)
+        import_sleep(conn, executor, sleep_paths, table_config, import_columns, args)
+    conn.close()
+    print("Import complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import os
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+PARTITIONED_SCHEMA = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "schema",
+    "build_tables_partitioned.sql",
+)
+
+
+def get_partitioned_ddl(table):
+    # the schema file has one block per table, separated by "--" lines
+    with open(PARTITIONED_SCHEMA, "r") as file:
+        blocks = file.read().split("\n--\n")
+    for block in blocks:
+        if re.search(rf"CREATE TABLE {table}\b", block):
+            return block
+    raise Exception("Table " + table + " is not in the partitioned schema.")
+
+
+def get_table_columns(cursor, table):
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = %s AND table_schema = current_schema() "
+        "ORDER BY ordinal_position",
+        (table,),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def migrate_table(conn, table, drop_old):
+    if app.is_partitioned_table(conn, table):
+        print("Table", table, "is already partitioned, skipping")
+        return
+    old_table = table + "_flat"
+    cursor = conn.cursor()
+
+    # move the flat table and its indexes out of the way
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes "
+        "WHERE tablename = %s AND schemaname = current_schema()",
+        (table,),
+    )
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"ALTER INDEX {index_name} RENAME TO {index_name}_flat")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    cursor.execute(get_partitioned_ddl(table))
+
+    # partitions for every month holding data, then copy the rows across
+    cursor.execute(f"SELECT min(start_time), max(start_time) FROM {old_table}")
+    data_start, data_end = cursor.fetchone()
+    if data_start is not None:
+        app.create_partitions(conn, table, data_start, data_end + timedelta(seconds=1))
+    columns = [
+        column
+        for column in get_table_columns(cursor, table)
+        if column in get_table_columns(cursor, old_table)
+    ]
+    cursor.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"SELECT {', '.join(columns)} FROM {old_table}"
+    )
+    print("Copied", cursor.rowcount, "rows into partitioned", table)
+    if drop_old:
+        cursor.execute(f"DROP TABLE {old_table}")
+    else:
+        print("Kept the original table as", old_table)
+    conn.commit()
+    cursor.close()
+
+
+def detach_partitions(conn, table, detach_before):
+    # detached partitions become plain tables that can be archived or dropped
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(%s)",
+        (table,),
+    )
+    for (partition_name,) in sorted(cursor.fetchall()):
+        match = re.fullmatch(rf"{table}_(\d{{4}})_(\d{{2}})", partition_name)
+        if match is None:
+            continue
+        partition_start = datetime(
+            int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc
+        )
+        partition_end = (partition_start + timedelta(days=32)).replace(day=1)
+        if partition_end <= detach_before:
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition_name}")
+            print("Detached", partition_name)
+    conn.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert intraday tables to monthly partitions, or detach old ones."
+    )
+    parser.add_argument(
+        "--table",
+        action="append",
+        help="table to convert, may be repeated, defaults to every intraday table",
+    )
+    parser.add_argument(
+        "--drop-old",
+        action="store_true",
+        help="drop the flat table after copying instead of keeping it as <table>_flat",
+    )
+    parser.add_argument(
+        "--detach-before",
+        help="ISO date, detach partitions that end on or before it instead of migrating",
+    )
+    parser.add_argument(
+        "--account",
+        help="configured account whose schema to convert, defaults to the default schema",
+    )
+    args = parser.parse_args()
+    tables = args.table or ["intraday_15m", "intraday_1m"]
+    if args.account:
+        accounts = app.load_accounts()
+        if args.account not in accounts:
+            raise Exception("Account " + args.account + " is not configured.")
+        app.use_account(args.account, accounts[args.account], (None, None, None))
+
+    conn = app.get_database_connection()
+    if args.detach_before:
+        detach_before = datetime.fromisoformat(args.detach_before)
+        if detach_before.tzinfo is None:
+            detach_before = detach_before.replace(tzinfo=timezone.utc)
+        for table in tables:
+            detach_partitions(conn, table, detach_before)
+    else:
+        for table in tables:
+            migrate_table(conn, table, args.drop_old)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+import backfill_prometheus
+
+
+class PrometheusStubHandler(BaseHTTPRequestHandler):
+    # answers range queries with one sample per step, value equal to its time,
+    # refusing ranges over the point limit like prometheus does
+    def do_GET(self):
+        params = {
+            key: values[0]
+            for key, values in parse_qs(urlparse(self.path).query).items()
+        }
+        start, end, step = (int(params[key]) for key in ["start", "end", "step"])
+        self.server.requests.append((start, end, step))
+        if (end - start) // step + 1 > self.server.max_points:
+            self.reply(400, {"status": "error", "error": "exceeded maximum resolution"})
+            return
+        values = [[epoch, str(epoch)] for epoch in range(start, end + 1, step)]
+        self.reply(
+            200,
+            {
+                "status": "success",
+                "data": {
+                    "resultType": "matrix",
+                    "result": [{"metric": {}, "values": values}],
+                },
+            },
+        )
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def prometheus_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PrometheusStubHandler)
+    server.requests = []
+    server.max_points = 100
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_range_is_split_into_chunks(prometheus_stub):
+    range_start = 1_700_000_000
+    step = 60
+    range_end = range_start + step * 349
+
+    epochs, values = backfill_prometheus.get_history(
+        f"http://127.0.0.1:{prometheus_stub.server_port}",
+        "sleep_sensor",
+        range_start,
+        range_end,
+        step,
+        prometheus_stub.max_points,
+        2,
+    )
+
+    # four chunks within the point limit, together the whole range once
+    assert len(prometheus_stub.requests) == 4
+    for chunk_start, chunk_end, chunk_step in prometheus_stub.requests:
+        assert chunk_step == step
+        assert (chunk_end - chunk_start) // step + 1 <= prometheus_stub.max_points
+    expected = np.arange(range_start, range_end + 1, step)
+    np.testing.assert_array_equal(epochs, expected)
+    np.testing.assert_array_equal(values, expected)
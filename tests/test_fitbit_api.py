@@ -0,0 +1,259 @@
+import json
+import os
+import sys
+import threading
+from datetime import datetime, time, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+STEPS_PATH = "/1/user/-/activities/steps/date/2026-01-01/1d/1min.json"
+STEPS_RESPONSE = {"activities-steps-intraday": {"dataset": []}}
+
+
+class FitbitStubHandler(BaseHTTPRequestHandler):
+    # replies with the response routed to the path, otherwise the queued
+    # responses in order, recording every request
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.server.requests.append(("GET", path, self.headers.get("authorization")))
+        if path in self.server.routes:
+            self.reply(self.server.routes[path])
+        else:
+            self.reply(self.server.responses.pop(0))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["content-length"])).decode()
+        self.server.requests.append(("POST", self.path, body))
+        self.reply(
+            (
+                200,
+                {},
+                {"access_token": "new-access", "refresh_token": "new-refresh"},
+            )
+        )
+
+    def reply(self, response):
+        status, headers, body = response
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def fitbit_stub(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FitbitStubHandler)
+    server.requests = []
+    server.responses = []
+    server.routes = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("FITBIT_API_URL", f"http://127.0.0.1:{server.server_port}")
+
+    # fresh tokens and rate limit, read from a temporary secrets folder
+    with open(tmp_path / "fitbit.json", "w") as file:
+        json.dump(
+            {
+                "client_id": "client",
+                "basic_token": "basic",
+                "access_token": "old-access",
+                "refresh_token": "old-refresh",
+            },
+            file,
+        )
+    monkeypatch.setitem(app.active_account, "name", None)
+    monkeypatch.setitem(app.active_account, "secrets_dir", str(tmp_path))
+    monkeypatch.setenv("SANDIEGO_FITBIT_CACHE_DIR", str(tmp_path / "fitbit_cache"))
+    monkeypatch.setitem(app.fitbit_auth, "secrets", None)
+    monkeypatch.setitem(app.fitbit_rate_limit, "limit", 150)
+    monkeypatch.setitem(app.fitbit_rate_limit, "remaining", 150)
+    monkeypatch.setitem(app.fitbit_rate_limit, "reset_at", 0.0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_steps_url():
+    url_schema = {"url_start": "/1/user/-/activities/steps/date/"}
+    return app.get_fitbit_url_start(url_schema) + "2026-01-01/1d/1min.json"
+
+
+def test_rate_limited_request_is_retried(fitbit_stub):
+    fitbit_stub.responses = [
+        (429, {"retry-after": "0"}, {"errors": [{"errorType": "rate_limit"}]}),
+        (200, {"fitbit-rate-limit-remaining": "148"}, STEPS_RESPONSE),
+    ]
+
+    assert app.query_fitbit(get_steps_url()) == STEPS_RESPONSE
+    assert [request[:2] for request in fitbit_stub.requests] == [
+        ("GET", STEPS_PATH),
+        ("GET", STEPS_PATH),
+    ]
+    assert app.fitbit_rate_limit["remaining"] <= 148
+
+
+def test_expired_token_is_refreshed_once(fitbit_stub, tmp_path):
+    fitbit_stub.responses = [
+        (401, {}, {"errors": [{"errorType": "expired_token"}]}),
+        (200, {}, STEPS_RESPONSE),
+    ]
+
+    assert app.query_fitbit(get_steps_url()) == STEPS_RESPONSE
+    assert [request[:2] for request in fitbit_stub.requests] == [
+        ("GET", STEPS_PATH),
+        ("POST", "/oauth2/token"),
+        ("GET", STEPS_PATH),
+    ]
+    assert fitbit_stub.requests[0][2] == "Bearer old-access"
+    assert "refresh_token=old-refresh" in fitbit_stub.requests[1][2]
+    assert fitbit_stub.requests[2][2] == "Bearer new-access"
+
+    # the rotated tokens are written back for the next run
+    with open(tmp_path / "fitbit.json", "r") as file:
+        fitbit_secrets = json.load(file)
+    assert fitbit_secrets["access_token"] == "new-access"
+    assert fitbit_secrets["refresh_token"] == "new-refresh"
+
+
+URL_SCHEMAS = {
+    "sleep": {
+        "url_start": "/1.2/user/-/sleep/date/",
+        "url_end": ".json",
+        "range_max_days": 3,
+    },
+    "steps": {
+        "url_start": "/1/user/-/activities/steps/date/",
+        "url_end": "/1d/1min.json",
+        "url_end_time": "/1d/1min/time/{start_time}/{end_time}.json",
+    },
+}
+
+
+def get_days_ago(days):
+    return (datetime.now(timezone.utc) - timedelta(days=days)).date()
+
+
+def get_fitbit_data(fitbit_type, query_start, query_end):
+    metric_config = {
+        "metric": {"provider": "fitbit", "fitbit_type": fitbit_type},
+    }
+    return app.get_data_fitbit(query_start, query_end, URL_SCHEMAS, metric_config)[
+        fitbit_type
+    ]
+
+
+def get_sleep_item(query_date):
+    return {"dateOfSleep": query_date.isoformat(), "minutesAsleep": 400}
+
+
+def test_range_requests_skip_cached_dates(fitbit_stub):
+    query_dates = [get_days_ago(days) for days in range(10, 2, -1)]
+    cached_date = query_dates[3].isoformat()
+    app.write_fitbit_cache(
+        app.get_fitbit_cache_path(URL_SCHEMAS["sleep"], "sleep", cached_date),
+        {"sleep": []},
+    )
+    fitbit_stub.routes = {
+        path: (200, {}, {"sleep": []})
+        for path in [
+            f"/1.2/user/-/sleep/date/{query_dates[0]}/{query_dates[2]}.json",
+            f"/1.2/user/-/sleep/date/{query_dates[4]}/{query_dates[6]}.json",
+            f"/1.2/user/-/sleep/date/{query_dates[7]}.json",
+        ]
+    }
+
+    # the cached date breaks the run, which is then split at range_max_days
+    data_sleep = get_fitbit_data(
+        "sleep",
+        datetime.combine(query_dates[0], time(0), timezone.utc),
+        datetime.combine(query_dates[-1], time(12), timezone.utc),
+    )
+    assert sorted(request[1] for request in fitbit_stub.requests) == sorted(
+        fitbit_stub.routes
+    )
+    assert list(data_sleep) == [query_date.isoformat() for query_date in query_dates]
+
+
+def test_range_response_is_split_per_date(fitbit_stub):
+    query_dates = [get_days_ago(days) for days in range(10, 7, -1)]
+    fitbit_stub.routes = {
+        f"/1.2/user/-/sleep/date/{query_dates[0]}/{query_dates[2]}.json": (
+            200,
+            {},
+            {"sleep": [get_sleep_item(query_dates[2]), get_sleep_item(query_dates[0])]},
+        )
+    }
+
+    data_sleep = get_fitbit_data(
+        "sleep",
+        datetime.combine(query_dates[0], time(0), timezone.utc),
+        datetime.combine(query_dates[-1], time(12), timezone.utc),
+    )
+    assert data_sleep == {
+        query_dates[0].isoformat(): {"sleep": [get_sleep_item(query_dates[0])]},
+        query_dates[1].isoformat(): {"sleep": []},
+        query_dates[2].isoformat(): {"sleep": [get_sleep_item(query_dates[2])]},
+    }
+
+    # every settled date is cached on its own, the empty date included
+    for query_date_str, date_response in data_sleep.items():
+        cache_path = app.get_fitbit_cache_path(
+            URL_SCHEMAS["sleep"], "sleep", query_date_str
+        )
+        assert app.read_fitbit_cache(cache_path) == date_response
+
+
+def test_settled_first_day_is_fetched_whole(fitbit_stub):
+    first_date = get_days_ago(5)
+    first_path = f"/1/user/-/activities/steps/date/{first_date}/1d/1min.json"
+    fitbit_stub.routes = {first_path: (200, {}, STEPS_RESPONSE)}
+
+    get_fitbit_data(
+        "steps",
+        datetime.combine(first_date, time(13, 30), timezone.utc),
+        datetime.combine(first_date, time(18, 45), timezone.utc),
+    )
+    assert [request[1] for request in fitbit_stub.requests] == [first_path]
+    cache_path = app.get_fitbit_cache_path(
+        URL_SCHEMAS["steps"], "steps", first_date.isoformat()
+    )
+    assert app.read_fitbit_cache(cache_path) == STEPS_RESPONSE
+
+
+def test_unsettled_days_are_trimmed(fitbit_stub):
+    yesterday = get_days_ago(1)
+    today = get_days_ago(0)
+    fitbit_stub.routes = {
+        path: (200, {}, STEPS_RESPONSE)
+        for path in [
+            f"/1/user/-/activities/steps/date/{yesterday}/1d/1min/time/22:00/23:59.json",
+            f"/1/user/-/activities/steps/date/{today}/1d/1min/time/00:00/10:15.json",
+        ]
+    }
+
+    get_fitbit_data(
+        "steps",
+        datetime.combine(yesterday, time(22), timezone.utc),
+        datetime.combine(today, time(10, 15), timezone.utc),
+    )
+    assert sorted(request[1] for request in fitbit_stub.requests) == sorted(
+        fitbit_stub.routes
+    )
+
+    # trimmed days are never cached
+    for query_date in [yesterday, today]:
+        cache_path = app.get_fitbit_cache_path(
+            URL_SCHEMAS["steps"], "steps", query_date.isoformat()
+        )
+        assert app.read_fitbit_cache(cache_path) is None
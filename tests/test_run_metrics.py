@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+
+@pytest.fixture
+def metrics_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("SANDIEGO_METRICS_FILE", str(tmp_path / "sandiego.prom"))
+    monkeypatch.setitem(app.active_account, "name", None)
+    monkeypatch.setitem(app.run_metrics, "current", {})
+    monkeypatch.setitem(app.run_metrics, "finished", {})
+    return tmp_path
+
+
+def test_worker_metrics_are_labelled_per_account(metrics_file, monkeypatch):
+    for account_name, rows in [("alice", 5), ("bob", 3)]:
+        monkeypatch.setitem(app.active_account, "name", account_name)
+        app.record_run_metric("sandiego_rows_written", {"table": "daily"}, rows)
+        app.export_run_metrics()
+
+    # the served metrics keep the last run of every account
+    assert 'sandiego_rows_written{account="alice",table="daily"} 5' in (
+        app.run_metrics["exported"]
+    )
+    assert 'sandiego_rows_written{account="bob",table="daily"} 3' in (
+        app.run_metrics["exported"]
+    )
+
+    # each account's file only holds its own run
+    with open(metrics_file / "sandiego-bob.prom", "r") as file:
+        bob_metrics = file.read()
+    assert 'sandiego_rows_written{account="bob",table="daily"} 3' in bob_metrics
+    assert "alice" not in bob_metrics
+    assert not (metrics_file / "sandiego.prom").exists()
+
+
+def test_single_account_metrics_have_no_account_label(metrics_file):
+    app.record_run_metric("sandiego_rows_written", {"table": "daily"}, 5)
+    app.export_run_metrics()
+
+    with open(metrics_file / "sandiego.prom", "r") as file:
+        assert 'sandiego_rows_written{table="daily"} 5' in file.read()